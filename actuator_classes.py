@@ -1,17 +1,56 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import re
 import time
-from threading import Thread, Event, Lock, Timer
+from threading import Thread, Event, Lock, Condition
 
-try:
-    import pydoocs
-    from hlc_util import Error
-except Exception as err:
-    print(err)
-    pass
+from control_system import pydoocs, Error
+from wait_classes import Deadline
+
+
+MAGNET_PATTERN = r'FLASH\.MAGNETS/MAGNET\.ML/([A-Z0-9])+/[A-Z]+\.SP'
+
+
+class TimingConfig(object):
+
+    TTL = 60.0
+
+    def __init__(self, ttl: float = None):
+        self.ttl = self.TTL if ttl is None else ttl
+        self._cache = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, address: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(address)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+        value = pydoocs.read(address)['data']
+        with self._lock:
+            self._cache[address] = (now + self.ttl, value)
+            self.misses += 1
+        return value
+
+    def invalidate(self, address: str = None):
+        with self._lock:
+            if address is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(address, None)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'saved_reads': self.hits,
+                'hit_ratio': (self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0)}
+
+
+timing_config = TimingConfig()
 
 
 def bunch_train_part(facility: str = 'FLASH', beamline: str = 'FLASH3'):
@@ -25,13 +64,100 @@ def bunch_train_part(facility: str = 'FLASH', beamline: str = 'FLASH3'):
         else:
             raise Error('bunch_train_part function error: beamline not implemented!!!')
         for i in range(3):
-            destination = pydoocs.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/DESTINATION_SELECT.' + str(i + 1))['data']
+            destination = timing_config.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/DESTINATION_SELECT.' + str(i + 1))
             if destination == destination_target:
                 return int(i + 1)
     else:
         raise Error('bunch_train_part function error: beamline not implemented!!!')
 
 
+class LaserGate(object):
+
+    POLL = 0.02
+
+    def __init__(self, address: str, timeout: float = 3):
+        self.address = address
+        self.timeout = timeout
+        self.state = None
+        self.condition = Condition()
+        self.subscribed = False
+        self.transitions = []
+
+    def update(self, blocked: bool):
+        with self.condition:
+            self.state = blocked
+            self.condition.notify_all()
+
+    def read(self):
+        blocked = bool(pydoocs.read(self.address)['data'])
+        self.update(blocked)
+        return blocked
+
+    def refresh(self):
+        self.read()
+        if not self.subscribed:
+            try:
+                subscribe = getattr(pydoocs, 'subscribe', None)
+            except Exception:
+                subscribe = None
+            if subscribe is not None:
+                try:
+                    subscribe(self.address, lambda data: self.update(bool(data['data'])))
+                    self.subscribed = True
+                except Exception as err:
+                    print('LaserGate: subscription failed ({}), polling instead'.format(err))
+
+    def close(self):
+        if self.subscribed:
+            try:
+                pydoocs.unsubscribe(self.address)
+            except Exception:
+                pass
+            self.subscribed = False
+
+    def start_transition(self, blocked: bool):
+        if self.state is None or not self.subscribed:
+            self.read()
+        if self.state == blocked:
+            return False
+        self.state = None
+        pydoocs.write(self.address, int(blocked))
+        return True
+
+    def transition_step(self, blocked: bool, wait: float = 0.0):
+        with self.condition:
+            if self.condition.wait_for(lambda: self.state == blocked, timeout=wait):
+                return True
+        return self.read() == blocked
+
+    def set(self, blocked: bool, timeout: float = None):
+        deadline = Deadline(timeout=self.timeout if timeout is None else timeout,
+                            name='laser.' + ('block' if blocked else 'unblock'))
+        if not self.start_transition(blocked):
+            return 0.0
+        while not self.transition_step(blocked, wait=self.POLL):
+            if deadline.expired:
+                self.state = None
+                deadline.fail('Laser class: TIMEOUT!!!')
+        deadline.done()
+        return self.record(blocked, deadline.elapsed)
+
+    def record(self, blocked: bool, duration: float):
+        self.update(blocked)
+        self.transitions.append((blocked, duration))
+        print('Laser {}: {:.3f} s'.format('blocked' if blocked else 'unblocked', duration))
+        return duration
+
+    @property
+    def stats(self):
+        stats = {}
+        for key, blocked in [('block', True), ('unblock', False)]:
+            durations = [d for b, d in self.transitions if b == blocked]
+            if durations:
+                stats[key] = {'count': len(durations), 'mean': float(np.mean(durations)), 'max': max(durations)}
+        return stats
+
+
 class Laser(object):
 
     TIMEOUT = 3
@@ -41,9 +167,9 @@ class Laser(object):
         self.beamline = beamline
         self._inhibit = inhibit
         self.check_args()
-        self.base_addr = 'FLASH.DIAG/LASER.CONTROL/LASER' + str(self.which_laser)
-        self.timer = Timer(interval=self.TIMEOUT, function=self.timeout)
-        self._timeout = False
+        self.base_addr = None
+        self.gate = None
+        self.refresh()
 
     def check_args(self):
         if self.facility == 'FLASH':
@@ -63,7 +189,7 @@ class Laser(object):
     @property
     def which_laser(self):
             btp = bunch_train_part(facility=self.facility, beamline=self.beamline)
-            return int(pydoocs.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/LASER_SELECT.' + str(btp))['data'])
+            return int(timing_config.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/LASER_SELECT.' + str(btp)))
 
     @property
     def rep_rate(self):
@@ -72,7 +198,7 @@ class Laser(object):
             event = 7
         elif laser == 2:
             event = 30
-        divider = int(pydoocs.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/EVENT' + str(event))['data'][3])
+        divider = int(timing_config.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/EVENT' + str(event))[3])
         if divider == 8:
             rep_rate = 1.0
         elif divider == 4:
@@ -83,74 +209,183 @@ class Laser(object):
             rep_rate = 10.0
         return rep_rate
 
+    def refresh(self):
+        self.base_addr = 'FLASH.DIAG/LASER.CONTROL/LASER' + str(self.which_laser)
+        address = '/'.join([self.base_addr, 'BLOCK_LASER'])
+        if self.gate is None or self.gate.address != address:
+            if self.gate is not None:
+                self.gate.close()
+            self.gate = LaserGate(address=address, timeout=self.TIMEOUT)
+        if not self.inhibit:
+            self.gate.refresh()
+
     @property
     def block(self):
-        if not self.inhibit:
-            try:
-                self.timer.cancel()
-            except:
-                pass
-            block_addr = '/'.join([self.base_addr, 'BLOCK_LASER'])
-            is_blocked = bool(pydoocs.read(block_addr)['data'])
-            if is_blocked: return
-            else:
-                try:
-                    self.timer.start()
-                except:
-                    pass
-                pydoocs.write(block_addr, 1)
-                while not self._timeout:
-                    is_blocked = bool(pydoocs.read(block_addr)['data'])
-                    if not is_blocked: time.sleep(0.1)
-                    else:
-                        self.timer.cancel()
-                        return
-                raise Error('Laser class: TIMEOUT!!!')
-        else:
-            pass
+        self.set_blocked(True)
 
     @property
     def unblock(self):
+        self.set_blocked(False)
+
+    def set_blocked(self, blocked: bool, timeout: float = None):
         if not self.inhibit:
-            block_addr = '/'.join([self.base_addr, 'BLOCK_LASER'])
-            is_blocked = bool(pydoocs.read(block_addr)['data'])
-            if not is_blocked: return
-            else:
-                try:
-                    self.timer.start()
-                except:
-                    pass
-                pydoocs.write(block_addr, 0)
-                while not self._timeout:
-                    is_blocked = bool(pydoocs.read(block_addr)['data'])
-                    if is_blocked: time.sleep(0.1)
-                    else:
-                        self.timer.cancel()
-                        return
-                raise Error('Laser class: TIMEOUT!!!')
+            self.gate.set(blocked, timeout=timeout)
         else:
             pass
 
-    def timeout(self):
-        self._timeout = True
+
+class SettleDetector(object):
+
+    WINDOW = 10
+    SLOPE_TOLERANCE = 1e-2
+
+    def __init__(self, window: int = None, slope_tolerance: float = None, target_tolerance: float = None):
+        self.window = int(window) if window else self.WINDOW
+        self.slope_tolerance = self.SLOPE_TOLERANCE if slope_tolerance is None else slope_tolerance
+        self.target_tolerance = target_tolerance
+        self.reset()
+
+    def reset(self, target: float = None):
+        self.target = target
+        self.count = 0
+        self.slope = None
+        self.drift = None
+        self.settle_time = None
+        self._values = np.zeros(self.window)
+        self._slopes = np.zeros(self.window)
+        self._n_slopes = 0
+        self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self._slope_sum = 0.0
+        self._t_start = time.monotonic()
+
+    def update(self, value: float):
+        x = float(self.count)
+        slot = self.count % self.window
+        if self.count >= self.window:
+            x_old, y_old = x - self.window, self._values[slot]
+            self._sx -= x_old
+            self._sy -= y_old
+            self._sxx -= x_old * x_old
+            self._sxy -= x_old * y_old
+        self._values[slot] = value
+        self._sx += x
+        self._sy += value
+        self._sxx += x * x
+        self._sxy += x * value
+        self.count += 1
+        n = min(self.count, self.window)
+        if n < 2:
+            return False
+        self.slope = (n * self._sxy - self._sx * self._sy) / (n * self._sxx - self._sx * self._sx)
+        slot = self._n_slopes % self.window
+        if self._n_slopes >= self.window:
+            self._slope_sum -= self._slopes[slot]
+        self._slopes[slot] = self.slope
+        self._slope_sum += self.slope
+        self._n_slopes += 1
+        self.drift = self._slope_sum / min(self._n_slopes, self.window)
+        settled = abs(self.drift) < self.slope_tolerance
+        if settled and self.target_tolerance is not None and self.target is not None:
+            settled = abs(value - self.target) < self.target_tolerance
+        if settled and self.settle_time is None:
+            self.settle_time = time.monotonic() - self._t_start
+        return settled
+
+
+class MagnetSettler(object):
+
+    TOLERANCE = 0.05
+    POLL = 0.1
+    MIN_WAIT = 0.3
+    MARGIN = 0.2
+    SETTLE_DELAY = 0.2
+    WEIGHT = 0.5
+    DEFAULT_RAMP_RATE = 1.0
+    DEFAULT_POLWENDE = 5.0
+
+    models = {}
+
+    def __init__(self, name: str, tolerance: float = None, poll: float = None, min_wait: float = None,
+                 margin: float = None, settle_delay: float = None):
+        self.name = name
+        self.tolerance = self.TOLERANCE if tolerance is None else tolerance
+        self.poll = self.POLL if poll is None else poll
+        self.min_wait = self.MIN_WAIT if min_wait is None else min_wait
+        self.margin = self.MARGIN if margin is None else margin
+        self.settle_delay = self.SETTLE_DELAY if settle_delay is None else settle_delay
+
+    @property
+    def model(self):
+        return self.models.setdefault(self.name, {'ramp_rate': None, 'polwende': None})
+
+    def predict(self, start: float, target: float):
+        ramp_rate = self.model['ramp_rate']
+        if ramp_rate is None:
+            return None
+        if start * target < 0:
+            return (abs(start) + abs(target)) / ramp_rate + (self.model['polwende'] or 0.0)
+        return abs(target - start) / ramp_rate
+
+    def estimate(self, start: float, target: float):
+        predicted = self.predict(start, target)
+        if predicted is None:
+            predicted = abs(target - start) / self.DEFAULT_RAMP_RATE
+            if start * target < 0:
+                predicted += self.DEFAULT_POLWENDE
+        return max(predicted, self.min_wait) + self.settle_delay
+
+    def first_poll(self, start: float, target: float):
+        predicted = self.predict(start, target)
+        if predicted is None:
+            return self.min_wait
+        return max(self.min_wait, predicted * (1 - self.margin) - self.poll)
+
+    def learn(self, start: float, target: float, duration: float):
+        model = self.model
+        if start * target < 0:
+            if model['ramp_rate'] is None:
+                return
+            polwende = max(duration - (abs(start) + abs(target)) / model['ramp_rate'], 0.0)
+            model['polwende'] = self._average(model['polwende'], polwende)
+        elif abs(target - start) > 2 * self.tolerance:
+            model['ramp_rate'] = self._average(model['ramp_rate'], abs(target - start) / duration)
+
+    def _average(self, old: float, new: float):
+        return new if old is None else (1 - self.WEIGHT) * old + self.WEIGHT * new
 
 
 class Actuator(Thread):
 
     busy = False
     TIMEOUT = 60
+    RATE = 1.0
+    OVERSHOOT = 1.0
 
-    def __init__(self, address_sp: str, address_rbv: str, stop_event: Event = None, **kwargs):
+    def __init__(self, address_sp: str, address_rbv: str, stop_event: Event = None, catalog=None,
+                 approach: str = None, overshoot: float = None, **kwargs):
         super().__init__()
         self.address_sp = address_sp
         self.address_rbv = address_rbv
+        self.catalog = catalog
+        if approach not in [None, 'up', 'down']:
+            raise ValueError('SimpleActuator class error: approach must be "up" or "down"!!!')
+        self.approach = approach
+        self.overshoot = self.OVERSHOOT if overshoot is None else abs(overshoot)
         self.target_value = None
+        self.start_value = None
         self.atype = 'generic'
+        self.settle_time = None
+        self.detector = SettleDetector(**kwargs.get('settle', {}))
         self.stop_event = stop_event
         self.init_event()
         self.check_args()
-        self.timer = Timer(interval=self.TIMEOUT, function=self.timeout)
-        self._timeout = False
+        self.settler = MagnetSettler(name="/".join(self.address_sp.split('/')[:-1]), **kwargs.get('magnet', {}))
+        self.deadline = None
+        self._t_start = None
+        self._next_poll = 0.0
+        self._observed = False
+        self._ready = False
+        self._timestamp = 0.0
 
     def init_event(self):
         if self.stop_event is None:
@@ -159,121 +394,193 @@ class Actuator(Thread):
         else:
             pass
 
-    def check_args(self):
-        try:
-            pydoocs.read(self.address_sp)
-        except Exception as err:
-            print('SimpleActuator class error: {}'.format(err))
-            raise err
-        else:
-            if re.match(r'FLASH\.MAGNETS/MAGNET\.ML/([A-Z0-9])+/[A-Z]+\.SP', self.address_sp):
-                self.atype = 'magnet'
-                if not bool(pydoocs.read("/".join(self.address_sp.split('/')[:-1] + ['PS_ON']))['data']):
-                    raise Exception('SimpleActuator class error: magnet is off!!!')
+    @staticmethod
+    def preflight_channels(address_sp: str, address_rbv: str):
+        channels = [address_sp, address_rbv]
+        if re.match(MAGNET_PATTERN, address_sp):
+            channels.append("/".join(address_sp.split('/')[:-1] + ['PS_ON']))
+        return channels
+
+    def read(self, address: str):
         try:
-            pydoocs.read(self.address_rbv)
+            if self.catalog is not None:
+                return self.catalog.read(address)
+            return pydoocs.read(address)
         except Exception as err:
             print('SimpleActuator class error: {}'.format(err))
             raise err
 
-    def set_value(self, target_value):
+    def check_args(self):
+        self.read(self.address_sp)
+        if re.match(MAGNET_PATTERN, self.address_sp):
+            self.atype = 'magnet'
+            if not bool(self.read("/".join(self.address_sp.split('/')[:-1] + ['PS_ON']))['data']):
+                raise Exception('SimpleActuator class error: magnet is off!!!')
+        self.read(self.address_rbv)
+
+    def overshoot_value(self, start: float, target: float):
+        if self.approach == 'up' and target < start:
+            return target - self.overshoot
+        if self.approach == 'down' and target > start:
+            return target + self.overshoot
+        return None
+
+    def estimate_move(self, start: float, target: float):
+        via = self.overshoot_value(start, target)
+        if via is not None:
+            return self._estimate_leg(start, via) + self._estimate_leg(via, target)
+        return self._estimate_leg(start, target)
+
+    def _estimate_leg(self, start: float, target: float):
+        if self.atype == 'magnet':
+            return self.settler.estimate(start, target)
+        return abs(target - start) / self.RATE
+
+    def set_value(self, target_value, timeout: float = None):
+        if self.approach is not None:
+            via = self.overshoot_value(pydoocs.read(self.address_rbv)['data'], target_value)
+            if via is not None:
+                print('{}: approaching {} {} via {}'.format(self.address_sp, target_value,
+                                                            'from below' if self.approach == 'up' else 'from above',
+                                                            via))
+                self._set_value(via, timeout=timeout)
+                if self.stop_event.is_set():
+                    return
+        self._set_value(target_value, timeout=timeout)
+
+    def _set_value(self, target_value, timeout: float = None):
+        self.deadline = Deadline(timeout=self.TIMEOUT if timeout is None else timeout, stop_event=self.stop_event,
+                                 name='actuator.' + self.atype)
+        self.start_move(target_value)
+        self.run()
+
+    def start_move(self, target_value):
         self.target_value = target_value
+        self.settle_time = None
+        self._t_start = time.monotonic()
+        self._observed = False
+        self._ready = False
         try:
-            self.timer.start()
-        except:
-            pass
-        try:
+            if self.atype == 'magnet':
+                self.start_value = pydoocs.read(self.address_rbv)['data']
             pydoocs.write(self.address_sp, self.target_value)
         except Exception as err:
             print('SimpleActuator class error: {}'.format(err))
             raise err
+        if self.atype == 'magnet':
+            predicted = self.settler.predict(self.start_value, self.target_value)
+            if predicted is not None:
+                print('{}: expected in {:.2f} s'.format(self.address_rbv, predicted))
+            self._next_poll = self.settler.first_poll(self.start_value, self.target_value)
         else:
-            self.run()
+            self.detector.reset(target=self.target_value)
+            self._timestamp = 0.0
+            self._next_poll = 0.0
+        return self._next_poll
 
-    def run(self):
-        self.busy = True
+    def settle_step(self):
         if self.atype == 'magnet':
-            time.sleep(1.0)
-            addr_idle = "/".join(self.address_sp.split('/')[:-1] + ['PS_IDLE'])
-            wait = True
-            while wait and not self.stop_event.is_set() and not self._timeout:
+            if self._ready:
+                self.settle_time = time.monotonic() - self._t_start
+            else:
                 current_value = pydoocs.read(self.address_rbv)['data']
-                if not -0.05 < current_value - self.target_value < 0.05:
+                if not -self.settler.tolerance < current_value - self.target_value < self.settler.tolerance:
                     print('{}: {:.3f}'.format(self.address_rbv, current_value - self.target_value))
-                    time.sleep(0.5)
-                    continue
-                elif not bool(pydoocs.read(addr_idle)['data']):
+                    self._observed = True
+                    return self.settler.poll
+                addr_idle = "/".join(self.address_sp.split('/')[:-1] + ['PS_IDLE'])
+                if not bool(pydoocs.read(addr_idle)['data']):
                     print('Polwende...')
-                    time.sleep(0.5)
-                    continue
-                else:
-                    time.sleep(0.5)
-                    wait = False
-                    self.timer.cancel()
-                    print('Ready!')
+                    self._observed = True
+                    return self.settler.poll
+                if self._observed:
+                    self.settler.learn(self.start_value, self.target_value, time.monotonic() - self._t_start)
+                self._ready = True
+                return self.settler.settle_delay
         else:
-            ring_buffer_data, ring_buffer_fit = np.zeros(10), np.zeros(10)
-            counter_data, counter_fit = 0, 0
-            timestamp_old = 0.0
+            data = pydoocs.read(self.address_rbv)
+            if data['timestamp'] == self._timestamp:
+                return 0.05
+            self._timestamp = data['timestamp']
+            settled = self.detector.update(data['data'])
+            if self.detector.count > 1:
+                print('{}: {:.3f}'.format(self.address_rbv, data['data'] - self.target_value))
+            if not settled:
+                return 0.0
+            self.settle_time = self.detector.settle_time
+        print('Ready! ({:.2f} s)'.format(self.settle_time))
+        return None
+
+    def run(self):
+        self.busy = True
+        self.settle_time = None
+        deadline = self.deadline if self.deadline is not None else \
+            Deadline(timeout=self.TIMEOUT, stop_event=self.stop_event, name='actuator.' + self.atype)
+        try:
+            delay = self._next_poll
             while True:
-                wait = True
-                while wait:
-                    data = pydoocs.read(self.address_rbv)
-                    if data['timestamp'] != timestamp_old:
-                        if counter_data < 10:
-                            ring_buffer_data[counter_data] = data['data']
-                        else:
-                            ring_buffer_data[counter_data % 10] = data['data']
-                        wait = False
-                        timestamp_old = data['timestamp']
-                        counter_data += 1
-                    else:
-                        time.sleep(0.05)
-                if counter_data < 2:
-                    continue
-                elif 1 < counter_data < 10:
-                    fit = np.polyfit(np.arange(counter_data), ring_buffer_data[:counter_data], 1)
-                    ring_buffer_fit[counter_fit] = fit[0]
-                    counter_fit += 1
-                    avg = np.average(ring_buffer_fit[:counter_fit])
-                    print('{}: {:.3f}'.format(self.address_rbv, data['data'] - self.target_value))
-                else:
-                    fit = np.polyfit(np.arange(10), ring_buffer_data, 1)
-                    ring_buffer_fit[counter_fit % 10] = fit[0]
-                    counter_fit += 1
-                    avg = np.average(ring_buffer_fit)
-                    print('{}: {:.3f}'.format(self.address_rbv, data['data'] - self.target_value))
-                if abs(avg) < 1e-2:
-                    print('Ready!')
-                    self.timer.cancel()
+                if delay:
+                    deadline.sleep(delay)
+                if deadline.stopped:
+                    break
+                if deadline.expired:
+                    deadline.fail('SimpleActuator class error: {} not settled after {} s!!!'.format(
+                        self.address_rbv, deadline.timeout))
+                delay = self.settle_step()
+                if delay is None:
                     break
-        self.busy = False
+            deadline.done()
+        finally:
+            self.busy = False
         return
 
-    def timeout(self):
-        self._timeout = True
-
 
-class ActuatorGroup(Thread):
+class ActuatorGroup(object):
 
-    def __init__(self, actuators: list):
-        super().__init__()
+    def __init__(self, actuators: list, stop_event: Event = None):
         self.actuators = actuators
+        self.stop_event = stop_event
+        if self.stop_event is None:
+            self.stop_event = Event()
+        self.futures = []
+        self.slowest = None
+        self.move_time = None
+        self._executor = ThreadPoolExecutor(max_workers=len(self.actuators), thread_name_prefix='ActuatorGroup')
 
-    def set_value(self, target_value: list):
+    def submit(self, target_value: list, timeout: float = None):
         if len(target_value) != len(self.actuators):
             raise ValueError
-        with ThreadPoolExecutor(max_workers=len(self.actuators)) as executor:
-            for act, value in zip(self.actuators, target_value):
-                executor.submit(act.set_value, target_value=value)
+        self.futures = [self._executor.submit(self._move, act, value, timeout)
+                        for act, value in zip(self.actuators, target_value)]
+        return self.futures
+
+    def set_value(self, target_value: list, timeout: float = None):
+        self.submit(target_value, timeout=timeout)
         self.run()
 
-    def run(self):
-        wait = True
-        while wait:
-            busy = [act.busy for act in self.actuators]
-            if np.any(busy):
-                time.sleep(0.1)
-            else:
-                wait = False
+    def run(self, timeout: float = None):
+        t_start = time.monotonic()
+        slowest = None
+        for future in as_completed(self.futures, timeout=timeout):
+            err = future.exception()
+            if err is not None:
+                self.stop_event.set()
+                for pending in self.futures:
+                    pending.cancel()
+                raise err
+            act, duration = future.result()
+            slowest = (act, duration)
+        self.move_time = time.monotonic() - t_start
+        if slowest is not None:
+            self.slowest = (slowest[0].address_sp, slowest[1])
+            print('Slowest actuator: {} ({:.2f} s)'.format(*self.slowest))
         return
+
+    @staticmethod
+    def _move(act: Actuator, value, timeout: float = None):
+        t_start = time.monotonic()
+        act.set_value(target_value=value, timeout=timeout)
+        return act, time.monotonic() - t_start
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
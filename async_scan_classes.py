@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import time
+
+from control_system import pydoocs
+
+from data_classes import Buffer, DataWriter, FLASHDataStruct, MacropulseTrigger
+from actuator_classes import Actuator, ActuatorGroup, timing_config
+from scan_classes import SimpleScan
+from setpoint_classes import OptimiserSetpoints
+from wait_classes import WaitTimeout, wait_stats
+
+
+class AsyncTrigger(object):
+
+    def __init__(self, loop, facility: str = 'FLASH'):
+        self.loop = loop
+        self.trigger = MacropulseTrigger.get(facility=facility)
+        self.event = asyncio.Event()
+        self.trigger.add_listener(self.notify)
+
+    @property
+    def polls(self):
+        return self.trigger.polls
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def acquire(self):
+        self.trigger.acquire()
+
+    def release(self):
+        self.trigger.release()
+
+    async def next(self, last: int):
+        while True:
+            self.event.clear()
+            macropulse = self.trigger.wait_next(last=last, timeout=0)
+            if macropulse is not None:
+                return macropulse
+            await self.event.wait()
+
+    def close(self):
+        self.trigger.remove_listener(self.notify)
+
+
+class AsyncScan(SimpleScan):
+
+    def __init__(self, config: dict = None, parent=None, filename: str = None):
+        self.loop = None
+        self.task = None
+        self.trigger = None
+        self.write_queue = None
+        self.write_error = None
+        self.written = 0
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='AsyncScanWriter')
+        super().__init__(config=config, parent=parent, filename=filename)
+
+    @property
+    def actuators(self):
+        return self.actuator.actuators if isinstance(self.actuator, ActuatorGroup) else [self.actuator]
+
+    async def call(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.catalog.reader.submit(fn, *args, **kwargs))
+
+    async def gather(self, *coros):
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def wait_for(self, coro, timeout: float, name: str, message: str, record: bool = True):
+        t_start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.TimeoutError:
+            wait_stats.record(name, time.monotonic() - t_start, timed_out=True)
+            raise WaitTimeout(message)
+        if record:
+            wait_stats.record(name, time.monotonic() - t_start)
+        return result
+
+    async def gate_laser(self, blocked: bool):
+        gate = self.laser.gate
+        if self.laser.inhibit:
+            return
+        t_start = time.monotonic()
+        if not await self.call(gate.start_transition, blocked):
+            return
+
+        async def wait():
+            while not await self.call(gate.transition_step, blocked):
+                await asyncio.sleep(gate.POLL)
+
+        try:
+            await self.wait_for(wait(), timeout=gate.timeout, name='laser.' + ('block' if blocked else 'unblock'),
+                                message='Laser class: TIMEOUT!!!')
+        except BaseException:
+            gate.state = None
+            raise
+        gate.record(blocked, time.monotonic() - t_start)
+
+    async def move(self, act: Actuator, target_value):
+        if act.approach is not None:
+            via = act.overshoot_value((await self.call(pydoocs.read, act.address_rbv))['data'], target_value)
+            if via is not None:
+                print('{}: approaching {} via {}'.format(act.address_sp, target_value, via))
+                await self.settle(act, via)
+        await self.settle(act, target_value)
+
+    async def settle(self, act: Actuator, target_value):
+        await self.wait_for(self._settle(act, target_value), timeout=act.TIMEOUT, name='actuator.' + act.atype,
+                            message='SimpleActuator class error: {} not settled after {} s!!!'.format(
+                                act.address_rbv, act.TIMEOUT))
+
+    async def _settle(self, act: Actuator, target_value):
+        delay = await self.call(act.start_move, target_value)
+        while delay is not None:
+            await asyncio.sleep(delay)
+            delay = await self.call(act.settle_step)
+
+    async def acquire(self, buffer: Buffer):
+        buffer.prepare()
+        m_old = 0
+        t_acquire = time.monotonic()
+        self.trigger.acquire()
+        try:
+            while not buffer.queue.full():
+                m_curr = await self.wait_for(self.trigger.next(last=m_old), timeout=buffer.TIMEOUT, name='buffer',
+                                             message='Buffer class: no new data within {} s!!!'.format(
+                                                 buffer.TIMEOUT), record=False)
+                timestamp = time.time()
+                t_start = time.perf_counter()
+                futures = buffer.reader.submit_read(buffer.channels)
+                await asyncio.gather(*[asyncio.wrap_future(future) for future in futures], return_exceptions=True)
+                results = buffer.reader.collect(buffer.channels, futures, t_start)
+                buffer.emit(buffer.parse_results(results, m_curr), m_curr, timestamp)
+                m_old = m_curr
+        finally:
+            self.trigger.release()
+        wait_stats.record('buffer', time.monotonic() - t_acquire)
+
+    async def submit(self, data_struct: dict, idx: tuple = None, grp_name: str = 'DATA'):
+        if self.write_error is not None:
+            raise self.write_error
+        if not self.dfile is None:
+            await self.write_queue.put((data_struct, idx, grp_name))
+
+    async def checkpoint(self, **state):
+        await self.submit(data_struct=state, grp_name=FLASHDataStruct.CHECKPOINT)
+
+    def store_metadata(self, step: tuple = None, values: dict = None, attrs: dict = None):
+        if not self.dfile is None:
+            self._io.submit(self.dump_metadata, step=step, values=values, attrs=attrs)
+
+    def dump_metadata(self, **item):
+        try:
+            self.dfile.dump_metadata(**item)
+        except Exception as err:
+            print('DataWriter class error: {}'.format(err))
+            if self.write_error is None:
+                self.write_error = err
+
+    def write_batch(self, batch: list):
+        appended = []
+        for data_struct, idx, grp_name in batch + [(None, None, None)]:
+            if appended and (idx is not None or grp_name != appended[0][2]):
+                self.dfile.append(data_structs=[b[0] for b in appended], grp_name=appended[0][2])
+                appended = []
+            if data_struct is None:
+                break
+            if grp_name == self.dfile.CHECKPOINT:
+                self.dfile.checkpoint(**data_struct)
+            elif idx is None:
+                appended.append((data_struct, idx, grp_name))
+            else:
+                self.dfile.dump(data_struct=data_struct, idx=idx, grp_name=grp_name)
+        self.written += len(batch)
+
+    async def write_loop(self):
+        while True:
+            batch = [await self.write_queue.get()]
+            while batch[-1] is not None and len(batch) < DataWriter.BATCH and not self.write_queue.empty():
+                batch.append(self.write_queue.get_nowait())
+            items = [item for item in batch if item is not None]
+            try:
+                if items:
+                    await self.loop.run_in_executor(self._io, self.write_batch, items)
+            except Exception as err:
+                print('DataWriter class error: {}'.format(err))
+                if self.write_error is None:
+                    self.write_error = err
+            finally:
+                for _ in batch:
+                    self.write_queue.task_done()
+            if batch[-1] is None:
+                return
+
+    async def set_actuator_async(self):
+        print('Setting new values...')
+        await self.gate_laser(blocked=True)
+        try:
+            index, value = self.next_setpoint()
+        except StopIteration:
+            print('No more values!!!')
+            self.flag = None
+            return
+        targets = value if isinstance(self.actuator, ActuatorGroup) else [value]
+        await self.gather(*[self.move(act, target) for act, target in zip(self.actuators, targets)])
+        self.step_counter += 1
+        self.step_index = index
+        self.record_step(value=value)
+        await self.gate_laser(blocked=False)
+        self.next_step()
+
+    async def collect_background_async(self):
+        print('Taking background...')
+        await self.gate_laser(blocked=True)
+        await self.acquire(self.background_buffer)
+        complete = self.background_buffer.queue.full() and not self.stop_event.is_set()
+        while not self.background_buffer.queue.empty():
+            await self.submit(data_struct=self.background_buffer.queue.get(), grp_name='background')
+        if complete:
+            await self.checkpoint(background=True)
+        self.next_step()
+
+    async def collect_data_async(self):
+        print('Polling data...')
+        await self.gate_laser(blocked=False)
+        await self.acquire(self.data_buffer)
+        await self.gate_laser(blocked=True)
+        self.next_step()
+
+    async def process_data_async(self):
+        print('Processing data...')
+        for data, idx in self.step_data():
+            await self.submit(data_struct=data, idx=idx)
+        if self.step_index is not None:
+            await self.checkpoint(**self.step_checkpoint())
+        self.next_step()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.trigger = AsyncTrigger(loop=self.loop, facility=self.facility)
+        self.stop_event.clear()
+        self.step_counter = self.first_step - 1
+        self.step_index = None
+        self.sequence = self.scan_sequence()
+        self.write_queue = asyncio.Queue(maxsize=max(DataWriter.QUEUE_SIZE, 2 * self.data_buffer.size))
+        with (self.dfile if not self.dfile is None else nullcontext()):
+            if not self.dfile is None:
+                self.prepare_file()
+            status = 'failed'
+            writer = asyncio.create_task(self.write_loop())
+            try:
+                await self.call(self.laser.refresh)
+                await self.gate_laser(blocked=True)
+                self.next_step()
+                while self.flag and not self.stop_event.is_set():
+                    if self.flag == 'set': await self.set_actuator_async()
+                    elif self.flag == 'background': await self.collect_background_async()
+                    elif self.flag == 'pause': await self.call(self.request_action)
+                    elif self.flag == 'collect': await self.collect_data_async()
+                    elif self.flag == 'process': await self.process_data_async()
+                    else: break
+                if isinstance(self.feedback, OptimiserSetpoints):
+                    best = self.finish_optimisation()
+                    if self.go_to_best and best is not None:
+                        await self.gather(*[self.move(act, target) for act, target in zip(self.actuators, best)])
+                status = 'aborted' if self.stop_event.is_set() else 'finished'
+            except asyncio.CancelledError:
+                print('Scan cancelled!')
+                status = 'aborted'
+            finally:
+                await self.write_queue.put(None)
+                await writer
+                print('Data writer: {} written'.format(self.written))
+                if not self.dfile is None:
+                    await self.loop.run_in_executor(
+                        self._io, lambda: self.dfile.dump_attrs(grp_name='METADATA', status=status))
+                self.laser.gate.close()
+                self.trigger.close()
+        if self.write_error is not None:
+            raise self.write_error
+        print('Scan finished!')
+        print('Timing configuration cache: {}'.format(timing_config.stats))
+        print('Macropulse polls: {}'.format(self.trigger.polls))
+        print('Waits: {}'.format(wait_stats.stats))
+        print('Laser transitions: {}'.format(self.laser.gate.stats))
+        if self.data_buffer.taps:
+            print('Live taps: {} bundles dropped'.format(self.data_buffer.dropped))
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        super().shutdown()
+        self._io.shutdown(wait=False)
+
+    def abort(self):
+        super().abort()
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import importlib
+import os
+
+try:
+    from hlc_util import Error
+except Exception as err:
+    print(err)
+
+    class Error(Exception):
+        pass
+
+
+class Backend(object):
+
+    def __init__(self, name: str):
+        self.name = name
+        self._module = None
+        self.load()
+
+    def load(self):
+        try:
+            self._module = importlib.import_module(self.name)
+        except Exception as err:
+            print(err)
+            self._module = None
+
+    def use(self, module):
+        self._module = module
+
+    @property
+    def available(self):
+        return self._module is not None
+
+    def __getattr__(self, item):
+        if self._module is None:
+            raise Error('{} backend not available!!!'.format(self.name))
+        return getattr(self._module, item)
+
+
+pydoocs = Backend('pydoocs')
+pydaq = Backend('pydaq')
+
+
+def use_simulator(simulator=None, **kwargs):
+    from simulator import MachineSimulator
+    if simulator is None:
+        simulator = MachineSimulator(**kwargs)
+    pydoocs.use(simulator)
+    pydaq.use(simulator.daq)
+    return simulator
+
+
+def use_machine():
+    pydoocs.load()
+    pydaq.load()
+
+
+if os.environ.get('SCAN_TOOL_BACKEND', '').lower() in ['sim', 'simulator']:
+    use_simulator()
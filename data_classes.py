@@ -1,33 +1,32 @@
 #!/usr/bin/env python3
 
 import collections
+import collections.abc
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
+from fnmatch import fnmatch
 import h5py
 import numpy as np
 import os
-from queue import Queue
+from queue import Queue, Empty, Full
 import sys
-from threading import Thread, Event, Timer
+from threading import Thread, Event, Condition, Lock
 import time
 
 
-try:
-    import pydoocs
-    import pydaq
-    from hlc_util import Error
-except Exception as err:
-    print(err)
-    pass
+from control_system import pydoocs, pydaq, Error
+from wait_classes import Deadline
 
-from actuator_classes import bunch_train_part
+from actuator_classes import bunch_train_part, timing_config
 
 
 def flatten(d, parent_key='', sep='.'):
     items = []
     for k, v in d.items():
         new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
+        if isinstance(v, collections.abc.MutableMapping):
             items.extend(flatten(v, new_key, sep=sep).items())
         else:
             items.append((new_key, v))
@@ -58,33 +57,302 @@ def get_size(obj, seen=None):
     return size
 
 
+MACROPULSE_CHANNELS = {'FLASH': 'FLASH.DIAG/TIMER/FLASHCPUTIME1.0/MACRO_PULSE_NUMBER',
+                       'XFEL_SIM': 'XFEL_SIM.DIAG/TIMER/TIME1/MACRO_PULSE_NUMBER'}
+
+
 def current_macropulse(facility: str = 'FLASH'):
-    if facility == 'FLASH':
-        return int(pydoocs.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/MACRO_PULSE_NUMBER')['data'][0])
-    if facility == 'XFEL_SIM':
-        return int(pydoocs.read('XFEL_SIM.DIAG/TIMER/TIME1/MACRO_PULSE_NUMBER')['data'][0])
+    if facility in MACROPULSE_CHANNELS:
+        return int(pydoocs.read(MACROPULSE_CHANNELS[facility])['data'][0])
+
+
+class MacropulseTrigger(Thread):
+
+    MIN_POLL = 0.002
+    POLL_FRACTION = 0.02
+    GUARD = 0.15
+    PERIOD_WEIGHT = 0.2
+
+    _instances = {}
+    _instances_lock = Lock()
+
+    def __init__(self, facility: str = 'FLASH'):
+        super().__init__(daemon=True)
+        self.facility = facility
+        self.address = MACROPULSE_CHANNELS[facility]
+        self.condition = Condition()
+        self.macropulse = 0
+        self.arrival = None
+        self.period = None
+        self.polls = 0
+        self.events = 0
+        self.subscribed = False
+        self.users = 0
+        self.parked = False
+        self.listeners = []
+        self._active = Event()
+        self._stop_event = Event()
+
+    @classmethod
+    def get(cls, facility: str = 'FLASH'):
+        with cls._instances_lock:
+            trigger = cls._instances.get(facility)
+            if trigger is None or not trigger.is_alive():
+                trigger = cls(facility=facility)
+                cls._instances[facility] = trigger
+                trigger.start()
+            return trigger
+
+    def wait_next(self, last: int = None, timeout: float = None):
+        with self.condition:
+            last = self.macropulse if last is None else last
+            arrived = self.condition.wait_for(lambda: (self.macropulse != last and not self.parked)
+                                              or self._stop_event.is_set(), timeout=timeout)
+            if not arrived or self.macropulse == last or self.parked:
+                return None
+            return self.macropulse
+
+    def acquire(self):
+        with self.condition:
+            self.users += 1
+            self._active.set()
+
+    def release(self):
+        with self.condition:
+            self.users = max(self.users - 1, 0)
+            if not self.users:
+                self._active.clear()
+
+    def add_listener(self, listener):
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l != listener]
+
+    def publish(self, macropulse: int):
+        now = time.monotonic()
+        with self.condition:
+            if macropulse == self.macropulse and not self.parked:
+                return
+            if macropulse != self.macropulse:
+                if self.arrival is not None and macropulse > self.macropulse:
+                    period = (now - self.arrival) / (macropulse - self.macropulse)
+                    self.period = period if self.period is None else \
+                        (1 - self.PERIOD_WEIGHT) * self.period + self.PERIOD_WEIGHT * period
+                self.macropulse = macropulse
+                self.arrival = now
+            self.parked = False
+            self.events += 1
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def subscribe(self):
+        try:
+            subscribe = getattr(pydoocs, 'subscribe', None)
+        except Exception:
+            subscribe = None
+        if subscribe is None:
+            return False
+        try:
+            subscribe(self.address, lambda data: self.publish(int(data['data'][0])))
+        except Exception as err:
+            print('MacropulseTrigger: subscription failed ({}), polling instead'.format(err))
+            return False
+        return True
+
+    def run(self):
+        self.subscribed = self.subscribe()
+        if self.subscribed:
+            self._stop_event.wait()
+            try:
+                pydoocs.unsubscribe(self.address)
+            except Exception:
+                pass
+            return
+        while not self._stop_event.is_set():
+            if not self._active.is_set():
+                with self.condition:
+                    self.parked = True
+                self._active.wait()
+                continue
+            try:
+                macropulse = current_macropulse(facility=self.facility)
+            except Exception as err:
+                print('MacropulseTrigger: {}'.format(err))
+                self._stop_event.wait(0.5)
+                continue
+            self.polls += 1
+            if macropulse != self.macropulse or self.parked:
+                self.publish(macropulse)
+                delay = self.period * (1 - self.GUARD) if self.period else self.MIN_POLL
+            else:
+                delay = self.period * self.POLL_FRACTION if self.period else self.MIN_POLL
+            self._stop_event.wait(max(delay, self.MIN_POLL))
+
+    def stop(self):
+        self._stop_event.set()
+        self._active.set()
+        with self.condition:
+            self.condition.notify_all()
+
+
+class ChannelReader(object):
+
+    MAX_WORKERS = 16
+    HISTORY = 100
+
+    def __init__(self, max_workers: int = None):
+        self._executor = ThreadPoolExecutor(max_workers=(min(max_workers, self.MAX_WORKERS) if max_workers
+                                                         else self.MAX_WORKERS),
+                                            thread_name_prefix='ChannelReader')
+        self.latency = collections.deque(maxlen=self.HISTORY)
+
+    @property
+    def last_latency(self):
+        return self.latency[-1] if self.latency else None
+
+    @property
+    def mean_latency(self):
+        return float(np.mean(self.latency)) if self.latency else None
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def read(self, channels: list):
+        t_start = time.perf_counter()
+        return self.collect(channels, self.submit_read(channels), t_start)
+
+    def submit_read(self, channels: list):
+        return [self._executor.submit(pydoocs.read, addr) for addr in channels]
+
+    def collect(self, channels: list, futures: list, t_start: float):
+        results = []
+        for addr, future in zip(channels, futures):
+            try:
+                results.append((addr, future.result(), None))
+            except Exception as err:
+                results.append((addr, None, err))
+        self.latency.append(time.perf_counter() - t_start)
+        return results
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class ChannelCatalog(object):
+
+    def __init__(self, reader: ChannelReader = None):
+        self.reader = reader if reader is not None else ChannelReader()
+        self.channels = {}
+        self.errors = {}
+
+    def __contains__(self, address: str):
+        return address in self.channels
+
+    def validate(self, channels: list):
+        pending = [addr for addr in dict.fromkeys(channels) if addr not in self.channels and addr not in self.errors]
+        for addr, data_struct, err in self.reader.read(pending):
+            if err is not None:
+                self.errors[addr] = err
+                continue
+            sample = np.asarray(data_struct['data'])
+            miscellaneous = dict(data_struct.get('miscellaneous', {}))
+            miscellaneous.update({'channel': addr})
+            self.channels[addr] = {'type': data_struct.get('type'),
+                                   'shape': sample.shape,
+                                   'dtype': sample.dtype,
+                                   'data_struct': data_struct,
+                                   'template': {'data': data_struct['data'],
+                                                'type': data_struct.get('type'),
+                                                'miscellaneous': miscellaneous}}
+        return {addr: self.errors[addr] for addr in channels if addr in self.errors}
+
+    def read(self, address: str):
+        if address not in self.channels and address not in self.errors:
+            self.validate([address])
+        if address in self.errors:
+            raise self.errors[address]
+        return self.channels[address]['data_struct']
+
+    def template(self, address: str):
+        return self.channels[address]['template']
+
+
+class AssemblyRing(object):
+
+    def __init__(self, channels: list, depth: int):
+        self.depth = depth
+        self.index = {addr: i for i, addr in enumerate(channels)}
+        self.full_mask = (1 << len(channels)) - 1
+        self.active = list(range(len(channels)))
+        self.tags = [-1] * depth
+        self.masks = [0] * depth
+        self.emitted = [False] * depth
+        self.slots = [[None] * len(channels) for _ in range(depth)]
+        self.completed = 0
+        self.evicted = 0
+        self.dropped = 0
+
+    def add(self, macropulse: int, channel: str, data_struct: dict):
+        bit = self.index.get(channel)
+        if bit is None:
+            return None
+        slot = macropulse % self.depth
+        tag = self.tags[slot]
+        if tag != macropulse:
+            if tag > macropulse:
+                self.dropped += 1
+                return None
+            if tag >= 0 and not self.emitted[slot] and self.masks[slot]:
+                self.evicted += 1
+            self.tags[slot] = macropulse
+            self.masks[slot] = 0
+            self.emitted[slot] = False
+        elif self.emitted[slot] or self.masks[slot] & (1 << bit):
+            return None
+        self.slots[slot][bit] = data_struct
+        self.masks[slot] |= 1 << bit
+        if self.masks[slot] & self.full_mask != self.full_mask:
+            return None
+        self.emitted[slot] = True
+        self.completed += 1
+        row = self.slots[slot]
+        bundle = np.empty(len(self.active), dtype=object)
+        bundle[:] = [row[i] for i in self.active]
+        return bundle
+
+    def discard(self, channel: str):
+        bit = self.index.get(channel)
+        if bit is not None and bit in self.active:
+            self.full_mask &= ~(1 << bit)
+            self.active.remove(bit)
 
 
 class Buffer(Thread):
 
     TIMEOUT = 3
     MAX_MACRO_DELAY = 20
+    WAIT_SLICE = 0.5
 
     def __init__(self, channels: list, size: int, sync: bool = False, stop_event: Event = None,
-                 facility: str = 'FLASH', beamline: str = 'FLASH3'):
+                 facility: str = 'FLASH', beamline: str = 'FLASH3', catalog: ChannelCatalog = None):
         super().__init__()
         self.channels = channels
+        self.catalog = catalog
         self._size = size
         self._sync = sync
         self.stop_event = stop_event
         self.facility = facility
         self.beamline = beamline
         self.queue = Queue(maxsize=size)
-        self.hist = np.zeros(self.MAX_MACRO_DELAY)
-        self.hist_count = 0
-        self.buffer = {}
-        self.timer = Timer(interval=self.TIMEOUT, function=self.timeout)
-        self._timeout = False
+        self.ring = None
+        self.reader = ChannelReader(max_workers=len(channels) + 1)
+        self.deadline = None
+        self.taps = []
+        self.tag = None
+        self.statistics = None
+        self.dropped = 0
         self.init_event()
 
     def init_event(self):
@@ -114,12 +382,12 @@ class Buffer(Thread):
     @property
     def rep_rate(self):
         btp = bunch_train_part(facility=self.facility, beamline=self.beamline)
-        laser = int(pydoocs.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/LASER_SELECT.' + str(btp))['data'])
+        laser = int(timing_config.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/LASER_SELECT.' + str(btp)))
         if laser == 1:
             event = 7
         elif laser == 2:
             event = 30
-        divider = int(pydoocs.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/EVENT' + str(event))['data'][3])
+        divider = int(timing_config.read('FLASH.DIAG/TIMER/FLASHCPUTIME1.0/EVENT' + str(event))[3])
         if divider == 8:
             rep_rate = 1.0
         elif divider == 4:
@@ -130,14 +398,22 @@ class Buffer(Thread):
             rep_rate = 10.0
         return rep_rate
 
-    def parse_channels(self):
+    @property
+    def read_latency(self):
+        return self.reader.last_latency
+
+    def parse_channels(self, m_curr: int = None):
+        m_future = self.reader.submit(current_macropulse, facility=self.facility) if m_curr is None else None
+        results = self.reader.read(self.channels)
+        return self.parse_results(results, m_curr if m_future is None else m_future.result())
+
+    def parse_results(self, results: list, m_curr: int):
         cycle_out = []
-        m_curr = current_macropulse(facility=self.facility)
-        for addr in self.channels:
-            try:
-                data_struct = pydoocs.read(addr)
-            except:
+        for addr, data_struct, err in results:
+            if err is not None:
                 self.channels = list(filter((addr).__ne__, self.channels))
+                if self.ring is not None:
+                    self.ring.discard(addr)
             else:
                 if data_struct['macropulse'] == 0:
                     data_struct['macropulse'] = m_curr
@@ -145,106 +421,177 @@ class Buffer(Thread):
                 cycle_out.append(data_struct)
         return np.array(cycle_out)
 
-    #def poll(self):
-    def run(self):
-        self.parse_channels()
+    def prepare(self):
+        if self.catalog is None:
+            self.parse_channels()
+        else:
+            self.channels = [addr for addr in self.channels if addr in self.catalog]
         if not self.channels:
             raise Exception('Buffer class ERROR: no channels given!!!')
-        if self.sync:
-            self.hist_count = 0
-            while not self.stop_event.is_set() and not self.queue.full() and not self._timeout:
-                try:
-                    self.timer.start()
-                    self._timeout = False
-                except:
-                    pass
-                m_curr = current_macropulse(facility=self.facility)
-                parsed_data = self.parse_channels()
-                parsed_macropulses = np.array([data['macropulse'] for data in parsed_data])
-                unique_macropulses = set(parsed_macropulses)
-                for m in unique_macropulses:
-                    if m < m_curr - self.MAX_MACRO_DELAY:
-                        try:
-                            del self.buffer[m]
-                            continue
-                        except:
-                            continue
-                    elif m in self.hist:
-                        try:
-                            del self.buffer[m]
-                            continue
-                        except:
-                            continue
-                    elif m in self.buffer.keys():
-                        self.buffer[m] += list(parsed_data[np.where(parsed_macropulses == m)[0]])
-                    else:
-                        self.buffer.update({m: list(parsed_data[np.where(parsed_macropulses == m)[0]])})
-                    unique_addrs, idxs_addrs = np.unique([data['miscellaneous']['channel'] for data in self.buffer[m]],
-                                                         return_index=True)
-                    if unique_addrs.size == len(self.channels):
-                        data_m = np.array(self.buffer[m])[idxs_addrs]
-                        data_struct = {'data': data_m,
-                                       'macropulse': m,
-                                       'miscellaneous': {'synchronous': 1,
-                                                         'samples': 1},
-                                       'timestamp': time.time(),
-                                       'type': 'A_DICT'}
-                        self.queue.put(data_struct)
-                        print(data_struct['macropulse'])
-                        try:
-                            del self.buffer[m]
-                        except:
-                            continue
-                        self.hist_count += 1
-                        self.hist[self.hist_count % self.MAX_MACRO_DELAY] = m
-                        self.timer.cancel()
-                time.sleep(0.05)
-        else:
+        self.ring = AssemblyRing(channels=self.channels, depth=2 * self.MAX_MACRO_DELAY) if self.sync else None
+
+    def add_tap(self, tap: Queue):
+        self.taps = self.taps + [tap]
+
+    def remove_tap(self, tap: Queue):
+        self.taps = [t for t in self.taps if t is not tap]
+
+    def publish(self, data_struct: dict):
+        if self.statistics is not None:
+            self.statistics.add(self.tag, data_struct)
+        for tap in self.taps:
+            try:
+                tap.put_nowait((self.tag, data_struct))
+            except Full:
+                self.dropped += 1
+
+    def emit(self, cycle: list, m_curr: int, timestamp: float = None):
+        if self.ring is None:
+            data_struct = {'data': cycle,
+                           'macropulse': m_curr,
+                           'miscellaneous': {'synchronous': 0,
+                                             'read_latency': self.read_latency},
+                           'timestamp': timestamp if timestamp is not None else time.time(),
+                           'type': 'A_DICT'}
+            self.queue.put(data_struct)
+            self.publish(data_struct)
+            print(data_struct['macropulse'])
+            return 1
+        emitted = 0
+        for data in cycle:
+            m = data['macropulse']
+            if m < m_curr - self.MAX_MACRO_DELAY:
+                continue
+            bundle = self.ring.add(macropulse=m, channel=data['miscellaneous']['channel'], data_struct=data)
+            if bundle is None:
+                continue
+            data_struct = {'data': bundle,
+                           'macropulse': m,
+                           'miscellaneous': {'synchronous': 1,
+                                             'samples': 1,
+                                             'read_latency': self.read_latency},
+                           'timestamp': time.time(),
+                           'type': 'A_DICT'}
+            self.queue.put(data_struct)
+            self.publish(data_struct)
+            print(data_struct['macropulse'])
+            emitted += 1
+            if self.queue.full():
+                break
+        return emitted
+
+    def poll(self, timeout: float = None):
+        self.deadline = Deadline(timeout=self.TIMEOUT if timeout is None else timeout, stop_event=self.stop_event,
+                                 name='buffer')
+        self.run()
+
+    def run(self):
+        deadline = self.deadline if self.deadline is not None else \
+            Deadline(timeout=self.TIMEOUT, stop_event=self.stop_event, name='buffer')
+        self.deadline = None
+        self.prepare()
+        trigger = MacropulseTrigger.get(facility=self.facility)
+        trigger.acquire()
+        try:
             m_old = 0
-            while not self.stop_event.is_set() and not self.queue.full() and not self._timeout:
-                try:
-                    self.timer.start()
-                    self._timeout = False
-                except:
-                    pass
-                wait = True
-                while wait:
-                    m_curr = current_macropulse()
-                    if m_curr != m_old:
-                        timestamp = time.time()
-                        parsed_addrs = self.parse_channels()
-                        data_struct = {'data': parsed_addrs,
-                                       'macropulse': m_curr,
-                                       'miscellaneous': {'synchronous': 0},
-                                       'timestamp': timestamp,
-                                       'type': 'A_DICT'}
-                        self.queue.put(data_struct)
-                        print(data_struct['macropulse'])
-                        m_old = m_curr
-                        wait = False
-                        self.timer.cancel()
-                    else:
-                        time.sleep(1 / self.rep_rate)
+            while not deadline.stopped and not self.queue.full():
+                if deadline.expired:
+                    deadline.fail('Buffer class: no new data within {} s ({} of {} samples)!!!'.format(
+                        deadline.timeout, self.queue.qsize(), self.size))
+                m_curr = trigger.wait_next(last=m_old, timeout=min(deadline.remaining, self.WAIT_SLICE))
+                if m_curr is None:
+                    continue
+                timestamp = time.time()
+                if self.emit(self.parse_channels(m_curr), m_curr, timestamp):
+                    deadline.renew()
+                m_old = m_curr
+        finally:
+            trigger.release()
+        deadline.done()
         return
 
+    def shutdown(self):
+        self.reader.shutdown()
+
     def get(self):
         if not self.queue.empty():
             return self.queue.get()
         else: return {}
 
-    def timeout(self):
-        self._timeout = True
+
+class StoragePolicy(object):
+
+    COMPRESSION = ['gzip', 'lzf', None]
+    APPEND_CHUNK = 16
+
+    def __init__(self, policies: dict = None):
+        self.policies = dict(policies) if policies else {}
+        for pattern, policy in self.policies.items():
+            if policy.get('compression') not in self.COMPRESSION:
+                raise ValueError('StoragePolicy: unknown compression {} for {}'.format(policy['compression'], pattern))
+            if policy.get('chunks', 'step') not in ['step', 'sample'] and not isinstance(policy['chunks'], list):
+                raise ValueError('StoragePolicy: chunks must be "step", "sample" or a list for {}'.format(pattern))
+
+    def lookup(self, channel: str):
+        policy = {}
+        for pattern, params in self.policies.items():
+            if pattern == 'default' or fnmatch(channel, pattern):
+                policy.update(params)
+        return policy
+
+    def dtype(self, channel: str, sample: np.ndarray):
+        policy = self.lookup(channel)
+        if 'dtype' in policy:
+            return np.dtype(policy['dtype'])
+        return np.result_type(sample.dtype, np.float32)
+
+    def dataset_kwargs(self, channel: str, shape: tuple, sample_shape: tuple, append: bool = False):
+        policy = self.lookup(channel)
+        kwargs = {}
+        if policy.get('compression'):
+            kwargs['compression'] = policy['compression']
+            if policy['compression'] == 'gzip' and 'compression_opts' in policy:
+                kwargs['compression_opts'] = int(policy['compression_opts'])
+        if policy.get('shuffle'):
+            kwargs['shuffle'] = True
+        chunks = policy.get('chunks', 'step' if kwargs else None)
+        if chunks is None:
+            return kwargs
+        if isinstance(chunks, list):
+            kwargs['chunks'] = tuple(chunks) + sample_shape
+        elif append:
+            kwargs['chunks'] = (int(policy.get('chunk_rows', self.APPEND_CHUNK)),) + sample_shape
+        elif chunks == 'step':
+            kwargs['chunks'] = (1,) * (len(shape) - 1) + shape[-1:] + sample_shape
+        else:
+            kwargs['chunks'] = (1,) * len(shape) + sample_shape
+        return kwargs
 
 
 class FLASHDataStruct(object):
+
+    MACROPULSE = '.macropulse'
+    TIMESTAMP = '.timestamp'
+    CHECKPOINT = '_checkpoint'
+    STEP_METADATA = '_step_metadata'
+    MEAN = '.mean'
+    STD = '.std'
+    COUNT = '.count'
+    GROWTH = 1.5
+    MIN_GROWTH = 64
+
     def __init__(self, filename: str, shape: tuple = None,
                  facility: str = 'FLASH', beamline: str = 'FL3',
                  DAQ_experiment: str = 'flashfwd', DAQ_run: int = 0,
-                 comment: str = 'None', script_name: str = 'None'):
+                 comment: str = 'None', script_name: str = 'None', storage: StoragePolicy = None,
+                 catalog: ChannelCatalog = None):
 
         self._h5file = None
         self._h5filename = filename
         self.shape = shape
+        self.storage = storage if storage is not None else StoragePolicy()
+        self.catalog = catalog
+        self._lengths = {}
 
         if os.path.isfile(self._h5filename):
             if not h5py.is_hdf5(self._h5filename):
@@ -269,93 +616,225 @@ class FLASHDataStruct(object):
                 h5.require_group('MACHINE_SNAPSHOT')
 
     def __enter__(self):
-        self._h5file = h5py.File(self._h5filename, 'a')
+        self.open()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._h5file.attrs['timestamp_stop'] = datetime.now().replace(microsecond=0).isoformat()
-        self._h5file.close()
+        self.close()
+
+    def open(self):
+        if self._h5file is None:
+            self._h5file = h5py.File(self._h5filename, 'a')
+        return self._h5file
+
+    def close(self):
+        if self._h5file is not None:
+            self._trim(self._h5file)
+            self._h5file.attrs['timestamp_stop'] = datetime.now().replace(microsecond=0).isoformat()
+            self._h5file.close()
+            self._h5file = None
+
+    def flush(self):
+        if self._h5file is not None:
+            self._h5file.flush()
+
+    @contextmanager
+    def _open(self):
+        if self._h5file is not None:
+            yield self._h5file
+        else:
+            with h5py.File(self._h5filename, 'a') as h5:
+                yield h5
 
     @property
     def get_keys(self):
-        with h5py.File(self._h5filename, 'a') as h5:
+        with self._open() as h5:
             print("Keys: %s" % list(h5.keys()))
             return list(h5.keys())
 
     @property
     def get_tree(self):
-        with h5py.File(self._h5filename, 'a') as h5:
+        with self._open() as h5:
             h5.visit(lambda name: print(name))
 
+    def _create_datasets(self, grp, channel: str, data: dict, shape: tuple = None):
+        sample = np.asarray(data['data'])
+        dtype = self.storage.dtype(channel, sample)
+        fillvalue = np.nan if np.issubdtype(dtype, np.floating) else 0
+        if shape is None:
+            kwargs = self.storage.dataset_kwargs(channel, (0,), sample.shape, append=True)
+            dset = grp.create_dataset(name=channel, shape=(0,) + sample.shape, maxshape=(None,) + sample.shape,
+                                      dtype=dtype, fillvalue=fillvalue, **kwargs)
+            grp.create_dataset(name=channel + self.MACROPULSE, shape=(0,), maxshape=(None,), dtype=np.int64)
+            grp.create_dataset(name=channel + self.TIMESTAMP, shape=(0,), maxshape=(None,), dtype=np.float64,
+                               fillvalue=np.nan)
+        else:
+            kwargs = self.storage.dataset_kwargs(channel, shape, sample.shape)
+            dset = grp.create_dataset(name=channel, shape=shape + sample.shape, dtype=dtype, fillvalue=fillvalue,
+                                      **kwargs)
+            grp.create_dataset(name=channel + self.MACROPULSE, shape=shape, dtype=np.int64)
+            grp.create_dataset(name=channel + self.TIMESTAMP, shape=shape, dtype=np.float64, fillvalue=np.nan)
+        attrs = flatten({k: v for k, v in data.items() if k not in ['data', 'macropulse', 'timestamp']})
+        for k, v in attrs.items():
+            dset.attrs[k] = v
+        dset.attrs['macropulse_dataset'] = channel.split('/')[-1] + self.MACROPULSE
+        dset.attrs['timestamp_dataset'] = channel.split('/')[-1] + self.TIMESTAMP
+        return dset
+
+    def prepare(self, channels: list, grp_name: str = 'DATA', append: bool = False):
+        if self.catalog is None:
+            return
+        with self._open() as h5:
+            grp = h5.require_group(grp_name.upper())
+            for channel in channels:
+                if channel in self.catalog and not channel in grp:
+                    self._create_datasets(grp, channel, self.catalog.template(channel),
+                                          shape=(None if append or self.shape is None else self.shape))
+
     def dump(self, data_struct: dict, idx: tuple = None, grp_name: str = 'DATA'):
-        with h5py.File(self._h5filename, 'a') as h5:
+        with self._open() as h5:
             grp = h5.require_group(grp_name.upper())
             if idx and not self.shape is None:
                 for data in data_struct['data']:
                     channel = data['miscellaneous']['channel']
                     if not channel in grp:
-                        if isinstance(data['data'], int) or isinstance(data['data'], float):
-                            dset = grp.create_dataset(name=channel, shape=self.shape, fillvalue=np.nan)
-                        elif isinstance(data['data'], np.ndarray):
-                            dset = grp.create_dataset(name=channel, shape=self.shape + data['data'].shape,
-                                                      fillvalue=np.nan)
+                        dset = self._create_datasets(grp, channel, data, shape=self.shape)
                     else:
                         dset = grp[channel]
                     dset[idx] = data['data']
-                    del data['data']
-                    data_attrs = flatten(data)
-                    if dset.attrs:
-                        macros = deepcopy(dset.attrs['macropulse'])
-                        macros[idx] = data_attrs['macropulse']
-                        timestamps = deepcopy(dset.attrs['timestamp'])
-                        timestamps[idx] = data_attrs['timestamp']
-                        dset.attrs['macropulse'] = macros
-                        dset.attrs['timestamp'] = timestamps
-                    else:
-                        macros = np.zeros(self.shape)
-                        macros[idx] = data_attrs['macropulse']
-                        del data_attrs['macropulse']
-                        dset.attrs['macropulse'] = macros
-                        timestamps = np.zeros(self.shape)
-                        timestamps[idx] = data_attrs['timestamp']
-                        del data_attrs['timestamp']
-                        dset.attrs['timestamp'] = timestamps
-                        for k, v in data_attrs.items():
-                            dset.attrs[k] = v
+                    grp[channel + self.MACROPULSE][idx] = data['macropulse']
+                    grp[channel + self.TIMESTAMP][idx] = data['timestamp']
             else:
-                for data in data_struct['data']:
-                    channel = data['miscellaneous']['channel']
-                    data = flatten(data)
-                    if not channel in grp:
-                        if isinstance(data['data'], int) or isinstance(data['data'], float):
-                            dset = grp.create_dataset(name=channel, data=np.array([data['data']]),
-                                                      maxshape=(None,),
-                                                      fillvalue=np.nan)
-                            dset.attrs['macropulse'] = np.array([data['macropulse']])
-                            dset.attrs['timestamp'] = np.array([data['timestamp']])
-                            del data['data'], data['macropulse'], data['timestamp']
-                        elif isinstance(data['data'], np.ndarray):
-                            dset = grp.create_dataset(name=channel,
-                                                      data=np.array([data['data']]),
-                                                      maxshape=(None,) + data['data'].shape,
-                                                      fillvalue=np.nan)
-                            dset.attrs['macropulse'] = np.array([data['macropulse']])
-                            dset.attrs['timestamp'] = np.array([data['timestamp']])
-                            del data['data'], data['macropulse'], data['timestamp']
-                        for k, v in data.items():
-                            dset.attrs[k] = v
+                self.append(data_structs=[data_struct], grp_name=grp_name)
+
+    def append(self, data_structs: list, grp_name: str = 'DATA'):
+        columns = {}
+        for data_struct in data_structs:
+            for data in data_struct['data']:
+                columns.setdefault(data['miscellaneous']['channel'], []).append(data)
+        with self._open() as h5:
+            grp = h5.require_group(grp_name.upper())
+            for channel, rows in columns.items():
+                if not channel in grp:
+                    dset = self._create_datasets(grp, channel, rows[0])
+                else:
+                    dset = grp[channel]
+                mdset, tdset = grp[channel + self.MACROPULSE], grp[channel + self.TIMESTAMP]
+                start = self._length(dset)
+                stop = start + len(rows)
+                if stop > dset.shape[0]:
+                    capacity = max(stop, int(dset.shape[0] * self.GROWTH), dset.shape[0] + self.MIN_GROWTH)
+                    for d in [dset, mdset, tdset]:
+                        d.resize(capacity, axis=0)
+                dset[start:stop] = np.stack([np.asarray(data['data']) for data in rows])
+                mdset[start:stop] = [data['macropulse'] for data in rows]
+                tdset[start:stop] = [data['timestamp'] for data in rows]
+                dset.attrs['length'] = stop
+                self._lengths[dset.name] = stop
+            if self._h5file is None:
+                self._trim(h5)
+
+    def truncate(self, grp_name: str):
+        with self._open() as h5:
+            grp = h5.require_group(grp_name.upper())
+            datasets = []
+            grp.visititems(lambda name, obj: datasets.append(obj) if isinstance(obj, h5py.Dataset) else None)
+            for dset in datasets:
+                if dset.maxshape[0] is None:
+                    dset.resize(0, axis=0)
+                    if 'length' in dset.attrs:
+                        dset.attrs['length'] = 0
+                    self._lengths.pop(dset.name, None)
+
+    def _length(self, dset):
+        if dset.name not in self._lengths:
+            self._lengths[dset.name] = int(dset.attrs.get('length', dset.shape[0]))
+        return self._lengths[dset.name]
+
+    def _trim(self, h5):
+        for name, length in self._lengths.items():
+            if name in h5 and h5[name].shape[0] != length:
+                for suffix in ['', self.MACROPULSE, self.TIMESTAMP]:
+                    h5[name + suffix].resize(length, axis=0)
+        self._lengths = {}
+
+    def dump_step_metadata(self, name: str, step, value):
+        value = np.asarray(value, dtype=float)
+        with self._open() as h5:
+            grp = h5.require_group('METADATA')
+            if not name in grp:
+                dset = grp.create_dataset(name=name, shape=self.shape[:-1] + value.shape, dtype=np.float64,
+                                          fillvalue=np.nan)
+            else:
+                dset = grp[name]
+            dset[step] = value
+
+    def dump_metadata(self, step: tuple = None, values: dict = None, attrs: dict = None):
+        for name, value in (values or {}).items():
+            self.dump_step_metadata(name=name, step=step, value=value)
+        if attrs:
+            self.dump_attrs(grp_name='METADATA', **attrs)
+
+    def dump_attrs(self, grp_name: str, **attrs):
+        with self._open() as h5:
+            grp = h5.require_group(grp_name)
+            for k, v in attrs.items():
+                grp.attrs[k] = v
+
+    def dump_statistics(self, step: tuple, statistics: dict):
+        with self._open() as h5:
+            grp = h5.require_group('ANALYSIS')
+            for channel, (count, mean, std) in statistics.items():
+                for suffix, value in [(self.MEAN, mean), (self.STD, std), (self.COUNT, count)]:
+                    if not channel + suffix in grp:
+                        dset = grp.create_dataset(name=channel + suffix, shape=self.shape[:-1] + value.shape,
+                                                  dtype=value.dtype, fillvalue=(0 if suffix == self.COUNT else np.nan))
                     else:
-                        dset = grp[channel]
-                        curr_idx = dset.shape[0]
-                        new_size = tuple([curr_idx + 1]) + (data['data'].shape if type(data['data']) == np.ndarray else ())
-                        dset.resize(new_size)
-                        dset[curr_idx] = data['data']
-                        dset.attrs['macropulse'] = np.append(dset.attrs['macropulse'], data['macropulse'])
-                        dset.attrs['timestamp'] = np.append(dset.attrs['timestamp'], data['timestamp'])
+                        dset = grp[channel + suffix]
+                    dset[step] = value
+
+    def checkpoint(self, step: int = None, step_index: tuple = None, samples: int = None, background: bool = False,
+                   statistics: dict = None):
+        if step_index is not None:
+            self.dump_step_metadata(name='samples_written', step=step_index, value=samples)
+        if step_index is not None and statistics:
+            self.dump_statistics(step=step_index, statistics=statistics)
+        attrs = {'checkpoint_time': datetime.now().replace(microsecond=0).isoformat()}
+        if step is not None:
+            attrs['checkpoint_step'] = step
+        if background:
+            attrs['background_done'] = 1
+        self.dump_attrs(grp_name='METADATA', **attrs)
+
+    def load_state(self):
+        with self._open() as h5:
+            attrs = dict(h5['METADATA'].attrs)
+        if 'config' not in attrs:
+            raise Error('FLASHDataStruct: {} has no scan configuration to resume from!!!'.format(self._h5filename))
+        return {'config': attrs['config'],
+                'status': attrs.get('status'),
+                'step': int(attrs.get('checkpoint_step', -1)),
+                'background': bool(attrs.get('background_done', 0))}
+
+    def written_samples(self, channels: list, grp_name: str = 'DATA'):
+        written = None
+        with self._open() as h5:
+            grp = h5.require_group(grp_name.upper())
+            for channel in channels:
+                if channel + self.MACROPULSE not in grp:
+                    continue
+                count = (grp[channel + self.MACROPULSE][()] != 0).sum(axis=-1)
+                written = count if written is None else np.minimum(written, count)
+        return written
+
+    def read_step(self, channel: str, idx: tuple, grp_name: str = 'DATA'):
+        with self._open() as h5:
+            grp = h5.require_group(grp_name.upper())
+            return grp[channel][idx], grp[channel + self.MACROPULSE][idx]
 
     def dump_settings(self, data_struct: dict, key: str = None):
         channels = [data['miscellaneous']['channel'] for data in data_struct['data']]
-        with h5py.File(self._h5filename, 'a') as h5:
+        with self._open() as h5:
             if key:
                 grp = h5.require_group('DEVICE_SETTINGS/' + key.upper())
             else:
@@ -384,10 +863,124 @@ class FLASHDataStruct(object):
         return
 
 
+class DataWriter(Thread):
+
+    QUEUE_SIZE = 100
+    BATCH = 50
+    _NOTHING = object()
+
+    def __init__(self, dfile: FLASHDataStruct, size: int = None):
+        super().__init__(daemon=True)
+        self.dfile = dfile
+        self.queue = Queue(maxsize=(size if size else self.QUEUE_SIZE))
+        self.error = None
+        self.submitted = 0
+        self.written = 0
+        self.max_depth = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self.write_time = 0.0
+
+    def submit(self, data_struct: dict, idx: tuple = None, grp_name: str = 'DATA'):
+        if self.error is not None:
+            raise self.error
+        item = (data_struct, idx, grp_name)
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.blocked += 1
+            t_start = time.perf_counter()
+            self.queue.put(item)
+            self.blocked_time += time.perf_counter() - t_start
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def checkpoint(self, **state):
+        self.submit(data_struct=state, grp_name=self.dfile.CHECKPOINT)
+
+    def metadata(self, **item):
+        self.submit(data_struct=item, grp_name=self.dfile.STEP_METADATA)
+
+    def flush(self, timeout: float = None):
+        with self.queue.all_tasks_done:
+            done = self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, timeout=timeout)
+        if self.error is not None:
+            raise self.error
+        if not done:
+            raise Error('DataWriter class: TIMEOUT while flushing!!!')
+        self.dfile.flush()
+
+    def stop(self, timeout: float = None):
+        if self.is_alive():
+            self.flush(timeout=timeout)
+            self.queue.put(None)
+            self.join(timeout=timeout)
+
+    def run(self):
+        pending = self._NOTHING
+        while True:
+            item = pending if pending is not self._NOTHING else self.queue.get()
+            pending = self._NOTHING
+            batch = [item]
+            try:
+                if item is None:
+                    return
+                t_start = time.perf_counter()
+                data_struct, idx, grp_name = item
+                if grp_name == self.dfile.CHECKPOINT:
+                    self.dfile.checkpoint(**data_struct)
+                elif grp_name == self.dfile.STEP_METADATA:
+                    self.dfile.dump_metadata(**data_struct)
+                elif idx is None:
+                    while len(batch) < self.BATCH:
+                        try:
+                            pending = self.queue.get_nowait()
+                        except Empty:
+                            pending = self._NOTHING
+                            break
+                        if pending is None or pending[1] is not None or pending[2] != grp_name:
+                            break
+                        batch.append(pending)
+                        pending = self._NOTHING
+                    self.dfile.append(data_structs=[b[0] for b in batch], grp_name=grp_name)
+                else:
+                    self.dfile.dump(data_struct=data_struct, idx=idx, grp_name=grp_name)
+                self.write_time += time.perf_counter() - t_start
+                self.written += len(batch)
+            except Exception as err:
+                print('DataWriter class error: {}'.format(err))
+                if self.error is None:
+                    self.error = err
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @property
+    def stats(self):
+        return {'submitted': self.submitted,
+                'written': self.written,
+                'pending': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'blocked': self.blocked,
+                'blocked_time': self.blocked_time,
+                'write_time': self.write_time}
+
+
 class DAQ_dump(object):
+
+    MACROPULSE = FLASHDataStruct.MACROPULSE
+    TIMESTAMP = FLASHDataStruct.TIMESTAMP
+    GROWTH = 1.5
+    MIN_GROWTH = 256
+    FLUSH_ROWS = 500
+
     def __init__(self, fname: str, start_time: str, stop_time: str, channels: list,
                  exp: str='flashfwd', ddir: str='/daq_data/flashfwd/EXP', local: bool = True):
         self._h5filename = fname
+        self._pending = {}
+        self._pending_rows = 0
+        self._index = {}
+        self.duplicates = 0
         self.start_time = start_time
         self.stop_time = stop_time
         self.channels = channels
@@ -413,6 +1006,107 @@ class DAQ_dump(object):
         else:
             pydaq.disconnect()
 
+    @staticmethod
+    def _length(dset):
+        return int(dset.attrs.get('length', dset.shape[0]))
+
+    def _create(self, h5, name: str, sample, attrs: dict):
+        if isinstance(sample, (str, bytes)):
+            dtype, sample_shape, fillvalue = h5py.string_dtype(), (), None
+        else:
+            sample = np.asarray(sample)
+            dtype, sample_shape = sample.dtype, sample.shape
+            fillvalue = np.nan if np.issubdtype(dtype, np.floating) else None
+        dset = h5.create_dataset(name=name, shape=(0,) + sample_shape, maxshape=(None,) + sample_shape,
+                                 dtype=dtype, fillvalue=fillvalue)
+        h5.create_dataset(name=name + self.MACROPULSE, shape=(0,), maxshape=(None,), dtype=np.int64)
+        h5.create_dataset(name=name + self.TIMESTAMP, shape=(0,), maxshape=(None,), dtype=np.float64,
+                          fillvalue=np.nan)
+        for k, v in attrs.items():
+            dset.attrs[k] = v
+        dset.attrs['macropulse_dataset'] = name.split('/')[-1] + self.MACROPULSE
+        dset.attrs['timestamp_dataset'] = name.split('/')[-1] + self.TIMESTAMP
+        dset.attrs['length'] = 0
+        return dset
+
+    def stack(self, h5, name: str, data, macropulse: int, timestamp: float, attrs: dict):
+        self._pending.setdefault(name, []).append((int(macropulse), timestamp, data, attrs))
+        self._pending_rows += 1
+        if self._pending_rows >= self.FLUSH_ROWS:
+            self.flush(h5)
+
+    def flush(self, h5):
+        for name, rows in self._pending.items():
+            if name in h5 and not isinstance(h5[name], h5py.Dataset):
+                raise Error('DAQ_dump: {} uses the old one-dataset-per-macropulse layout!!!'.format(name))
+            if not name in h5:
+                self._create(h5, name, rows[0][2], rows[0][3])
+            dset, mdset, tdset = h5[name], h5[name + self.MACROPULSE], h5[name + self.TIMESTAMP]
+            length = self._length(dset)
+            if name not in self._index:
+                self._index[name] = mdset[:length]
+            index = self._index[name]
+            rows.sort(key=lambda row: row[0])
+            new, last = [], None
+            for row in rows:
+                pos = np.searchsorted(index, row[0])
+                if row[0] == last or (pos < length and index[pos] == row[0]):
+                    self.duplicates += 1
+                elif dset.dtype.kind != 'O' and np.shape(row[2]) != dset.shape[1:]:
+                    print('DAQ_dump: {} macropulse {} has shape {}, expected {}... skipping'.format(
+                        name, row[0], np.shape(row[2]), dset.shape[1:]))
+                else:
+                    new.append(row)
+                    last = row[0]
+            if not new:
+                continue
+            start = int(np.searchsorted(index, new[0][0]))
+            stop = length + len(new)
+            macropulse = np.concatenate([index[start:], [row[0] for row in new]]).astype(np.int64)
+            timestamp = np.concatenate([tdset[start:length], [row[1] for row in new]])
+            if dset.dtype.kind == 'O':
+                data = np.array(list(dset.asstr()[start:length]) + [row[2] for row in new], dtype=object)
+            else:
+                data = np.concatenate([dset[start:length], np.stack([np.asarray(row[2]) for row in new])])
+            if start < length:
+                order = np.argsort(macropulse, kind='stable')
+                macropulse, timestamp, data = macropulse[order], timestamp[order], data[order]
+            if stop > dset.shape[0]:
+                capacity = max(stop, int(dset.shape[0] * self.GROWTH), dset.shape[0] + self.MIN_GROWTH)
+                for d in [dset, mdset, tdset]:
+                    d.resize(capacity, axis=0)
+            dset[start:stop] = data
+            mdset[start:stop] = macropulse
+            tdset[start:stop] = timestamp
+            dset.attrs['length'] = stop
+            self._index[name] = np.concatenate([index[:start], macropulse])
+        self._pending = {}
+        self._pending_rows = 0
+
+    def trim(self, h5):
+        for name, index in self._index.items():
+            for suffix in ['', self.MACROPULSE, self.TIMESTAMP]:
+                h5[name + suffix].resize(len(index), axis=0)
+
+    @staticmethod
+    def list_channels(fname: str):
+        names = []
+        with h5py.File(fname, 'r') as h5:
+            h5.visititems(lambda name, obj: names.append(name)
+                          if isinstance(obj, h5py.Dataset) and 'macropulse_dataset' in obj.attrs else None)
+        return names
+
+    @staticmethod
+    def read(fname: str, channel: str, start: int = None, stop: int = None):
+        with h5py.File(fname, 'r') as h5:
+            dset = h5[channel]
+            length = DAQ_dump._length(dset)
+            macropulse = h5[channel + DAQ_dump.MACROPULSE][:length]
+            i_start = 0 if start is None else int(np.searchsorted(macropulse, start, side='left'))
+            i_stop = length if stop is None else int(np.searchsorted(macropulse, stop, side='left'))
+            data = dset.asstr()[i_start:i_stop] if dset.dtype.kind == 'O' else dset[i_start:i_stop]
+            return data, macropulse[i_start:i_stop]
+
     def poll(self):
         try:
             pydaq.connect(start=self.start_time, stop=self.stop_time, chans=self.channels,
@@ -433,12 +1127,12 @@ class DAQ_dump(object):
                     print('Loop count: {}'.format(loop_count))
                     try:
                         channels = pydaq.getdata()
+                        if channels is None:
+                            break
                         if not channels:
                             time.sleep(0.001)
                             emptycount += 1
                             continue
-                        if channels is None:
-                            break
                         for chan_list in channels:
                             for subchan in chan_list:
                                 dtype = subchan['type']
@@ -464,40 +1158,32 @@ class DAQ_dump(object):
                                     break
                                 grp_name = '/'.join([daq_name, prop])
                                 print(grp_name, macropulse)
-                                grp = h5.require_group(name=grp_name)
-                                if not str(macropulse) in grp:
-                                    attrs = flatten(subchan)
-                                    dset = grp.create_dataset(data=data, name=str(macropulse))
-                                    for k, v in attrs.items():
-                                        dset.attrs[k] = v
-                                else:
-                                    continue
+                                self.stack(h5, grp_name, data, macropulse, subchan.get('timestamp', np.nan),
+                                           flatten(subchan))
                     except Exception as err:
                         print('Something wrong ... stopping %s'%str(err))
                         stop = True
                         pydaq.disconnect()
+                self.flush(h5)
+                self.trim(h5)
             pydaq.disconnect()
         elif not self.local:  # slow channels
             with h5py.File(self._h5filename, 'a') as h5:
                 while not stop and (emptycount < 100000):
                     try:
                         result = pydaq.getdata()
+                        if result is None:
+                            break
                         if result:
                             print('data found!')
                             for data_struct in result:
                                 daq_name = data_struct['miscellaneous']['daqname']
                                 macropulse = data_struct['macropulse']
                                 print(daq_name, macropulse)
-                                grp = h5.require_group(daq_name)
-                                if not str(macropulse) in grp:
-                                    data = data_struct['data'][0][1]
-                                    del data_struct['data']
-                                    attrs = flatten(data_struct)
-                                    dset = grp.create_dataset(data=data, name=str(macropulse))
-                                    for k, v in attrs.items():
-                                        dset.attrs[k] = v
-                                else:
-                                    continue
+                                data = data_struct['data'][0][1]
+                                del data_struct['data']
+                                self.stack(h5, daq_name, data, macropulse, data_struct.get('timestamp', np.nan),
+                                           flatten(data_struct))
                         else:
                             print('empty count')
                             time.sleep(0.001)
@@ -507,4 +1193,6 @@ class DAQ_dump(object):
                         print('Something wrong ... stopping %s' % str(err))
                         stop = True
                         pydaq.disconnect()
+                self.flush(h5)
+                self.trim(h5)
             pydaq.disconnect()
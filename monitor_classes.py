@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import collections
+import numpy as np
+from queue import Queue, Empty
+from threading import Lock
+
+
+class RunningStats(object):
+
+    def __init__(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.mean is None:
+            self.count = np.zeros(x.shape, dtype=np.int64)
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+        elif x.shape != self.mean.shape:
+            raise ValueError('RunningStats: sample shape {} != {}'.format(x.shape, self.mean.shape))
+        valid = np.isfinite(x)
+        self.count = self.count + valid
+        delta = np.where(valid, x - self.mean, 0.0)
+        self.mean = self.mean + delta / np.maximum(self.count, 1)
+        self.m2 = self.m2 + delta * np.where(valid, x - self.mean, 0.0)
+
+    @property
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+    @property
+    def result(self):
+        return self.count.copy(), np.where(self.count > 0, self.mean, np.nan), self.std
+
+
+class StepStatistics(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self.steps = collections.OrderedDict()
+        self.summary = collections.OrderedDict()
+        self.values = {}
+        self.skipped = set()
+
+    @staticmethod
+    def reduce(result: tuple):
+        count, mean, std = result
+        if not count.any():
+            return None
+        spread = float(np.nanmean(std)) if np.isfinite(std).any() else 0.0
+        return int(count.max()), float(np.nanmean(mean)), spread
+
+    def update(self, step: tuple, channel: str, sample):
+        if channel in self.skipped:
+            return
+        stats = self.steps.setdefault(step, {}).setdefault(channel, RunningStats())
+        try:
+            stats.update(sample)
+        except (TypeError, ValueError) as err:
+            print('StepStatistics: skipping {} ({})'.format(channel, err))
+            self.skipped.add(channel)
+            self.steps[step].pop(channel)
+
+    def add(self, tag: dict, bundle: dict):
+        if tag is None or tag['step'] is None:
+            return
+        with self._lock:
+            self.values[tag['step']] = tag['value']
+            for d in bundle['data']:
+                self.update(tag['step'], d['miscellaneous']['channel'], d['data'])
+
+    def seed(self, step: tuple, channel: str, samples):
+        with self._lock:
+            for sample in samples:
+                self.update(step, channel, sample)
+
+    def finish(self, step: tuple):
+        with self._lock:
+            results = {channel: stats.result for channel, stats in self.steps.pop(step, {}).items()}
+            self.summary[step] = {channel: self.reduce(result) for channel, result in results.items()}
+        return results
+
+    def scalar(self, step: tuple, channel: str):
+        with self._lock:
+            if step in self.summary:
+                return self.summary[step].get(channel)
+            if channel in self.steps.get(step, {}):
+                return self.reduce(self.steps[step][channel].result)
+        return None
+
+    def curve(self, channel: str, axis: int = 0):
+        rows = []
+        with self._lock:
+            steps = list(self.summary) + list(self.steps)
+        for step in steps:
+            reduced = self.scalar(step, channel)
+            if reduced is None or step not in self.values:
+                continue
+            value = self.values[step]
+            x = value[axis] if isinstance(value, (list, tuple, np.ndarray)) else value
+            rows.append((float(x), reduced[1], reduced[2]))
+        if not rows:
+            return np.array([]), np.array([]), np.array([])
+        rows.sort()
+        x, mean, std = (np.array(col, dtype=float) for col in zip(*rows))
+        return x, mean, std
+
+
+class StepMonitor(object):
+
+    TAP_SIZE = 200
+    MAX_DRAIN = 100
+    MAX_POINTS = 2000
+
+    def __init__(self, channel: str, statistics: StepStatistics, axis: int = 0):
+        self.channel = channel
+        self.statistics = statistics
+        self.axis = axis
+        self.tap = Queue(maxsize=self.TAP_SIZE)
+        self.buffer = None
+        self.points = collections.deque(maxlen=self.MAX_POINTS)
+        self.received = 0
+
+    def attach(self, buffer):
+        self.detach()
+        self.buffer = buffer
+        buffer.add_tap(self.tap)
+
+    def detach(self):
+        if self.buffer is not None:
+            self.buffer.remove_tap(self.tap)
+            self.buffer = None
+
+    def reduce(self, bundle: dict):
+        for d in bundle['data']:
+            if d['miscellaneous']['channel'] == self.channel:
+                return float(np.mean(d['data']))
+        return None
+
+    def position(self, value):
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return float(value[self.axis])
+        return float(value)
+
+    def add(self, tag: dict, bundle: dict):
+        if tag is None or tag['step'] is None:
+            return False
+        y = self.reduce(bundle)
+        if y is None or not np.isfinite(y):
+            return False
+        self.points.append((self.position(tag['value']), y))
+        return True
+
+    def drain(self, limit: int = None):
+        updated = 0
+        for _ in range(self.MAX_DRAIN if limit is None else limit):
+            try:
+                tag, bundle = self.tap.get_nowait()
+            except Empty:
+                break
+            self.received += 1
+            updated += self.add(tag, bundle)
+        return updated
+
+    def curve(self):
+        return self.statistics.curve(channel=self.channel, axis=self.axis)
+
+    def scatter(self):
+        if not self.points:
+            return np.array([]), np.array([])
+        x, y = zip(*self.points)
+        return np.array(x), np.array(y)
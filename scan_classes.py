@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
-from functools import reduce
 from concurrent.futures import ThreadPoolExecutor
-from itertools import repeat, count
+from contextlib import nullcontext
+from copy import deepcopy
+from itertools import count, chain
 import json
 import logging
 import numpy as np
@@ -17,15 +18,13 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
-try:
-    import pydoocs
-    from hlc_util import Error
-except Exception as err:
-    print(err)
-    pass
+from control_system import pydoocs, Error
 
-from data_classes import Buffer, FLASHDataStruct
-from actuator_classes import Laser, Actuator, ActuatorGroup
+from data_classes import Buffer, FLASHDataStruct, DataWriter, StoragePolicy, ChannelCatalog
+from actuator_classes import Laser, Actuator, ActuatorGroup, timing_config
+from wait_classes import wait_stats
+from setpoint_classes import SetpointOrder, SetpointGrid, AdaptiveSetpoints, OptimiserSetpoints
+from monitor_classes import StepStatistics
 
 
 class SimpleScan(object):
@@ -33,56 +32,135 @@ class SimpleScan(object):
     flag = None
     stop_event = Event()
 
-    def __init__(self, config: dict = None, parent=None):
+    def __init__(self, config: dict = None, parent=None, filename: str = None):
         self.parent = parent
+        self.config = None
+        self.filename = filename
+        self.first_step = 0
+        self.sample_offset = 0
+        self.step_written = 0
+        self.samples = None
+        self.background_done = False
         self.facility = None
         self.beamline = None
         self.laser = None
         self.actuator = None
         self.setpoint_values = None
+        self.setpoint_order = None
+        self.ordering = None
         self.scan_steps = None
+        self.scan_shape = None
+        self.scan_type = None
+        self.step_index = None
+        self.feedback = None
+        self.signal = None
+        self.go_to_best = False
         self.data_channels = None
         self.data_buffer = None
         self.background_buffer = None
+        self.statistics = StepStatistics()
+        self.step_statistics = None
         self.take_background = False
         self.mode = None
         self.sequence = None
         self.dfile = None
+        self.writer = None
+        self.catalog = None
         self.step_counter = None
         self.load_config(config=config)
 
+    def preflight(self, config: dict):
+        channels = list(config['sensor'])
+        for params in config['actuator']:
+            channels += Actuator.preflight_channels(params['address_sp'], params['address_rbv'])
+        t_start = time.perf_counter()
+        failed = self.catalog.validate(channels)
+        print('Pre-flight: {} channels checked in {:.3f} s'.format(len(set(channels)), time.perf_counter() - t_start))
+        for addr, err in failed.items():
+            print('Pre-flight: {} not available ({})'.format(addr, err))
+        return failed
+
     def load_config(self, config: dict):
+        self.config = deepcopy(config)
+
+        # pre-flight:
+        self.catalog = ChannelCatalog()
+        self.preflight(config=config)
+
         # actuator
-        actuators = [Actuator(**params, stop_event=self.stop_event) for params in config['actuator']]
+        actuators = [Actuator(**params, stop_event=self.stop_event, catalog=self.catalog)
+                     for params in config['actuator']]
         if len(actuators) > 1:
-            self.actuator = ActuatorGroup(actuators=actuators)
-            values = [act['values'] for act in config['actuator']]
-            self.setpoint_values = iter([[lst[i] for lst in values] for i in range(len(values[0]))])
-            self.scan_steps = len(values[0])
+            self.actuator = ActuatorGroup(actuators=actuators, stop_event=self.stop_event)
         else:
             self.actuator = actuators[0]
-            values = config['actuator'][0]['values']
-            self.setpoint_values = iter(values)
-            self.scan_steps = len(values)
+        values = [act['values'] for act in config['actuator']]
+        self.scan_type = str(config['scan_params'].get('scan_type', 'simple scan'))
+        if self.scan_type == 'grid scan':
+            grid = SetpointGrid(axes=values, serpentine=bool(config['scan_params'].get('serpentine', 1)))
+            self.ordering = 'serpentine' if grid.serpentine else 'none'
+            self.setpoint_order = None
+            self.setpoint_values = iter(grid)
+            self.scan_shape = grid.shape
+            self.scan_steps = len(grid)
+        elif self.scan_type in ['adaptive scan', 'optimisation scan']:
+            scan_params = config['scan_params']
+            if self.scan_type == 'adaptive scan':
+                self.feedback = AdaptiveSetpoints(axes=values,
+                                                  budget=int(scan_params.get('budget', 2 * len(SetpointGrid(values)))),
+                                                  resolution=scan_params.get('resolution'))
+            else:
+                start = scan_params.get('start', [self.catalog.read(act.address_rbv)['data'] for act in actuators])
+                self.config['scan_params']['start'] = [float(v) for v in start]
+                self.feedback = OptimiserSetpoints(axes=values,
+                                                   budget=int(scan_params.get('budget', 30)),
+                                                   start=start,
+                                                   step=scan_params.get('step'),
+                                                   goal=str(scan_params.get('goal', 'max')),
+                                                   resolution=scan_params.get('resolution'))
+            self.signal = scan_params.get('signal', config['sensor'][0])
+            self.ordering = self.scan_type.split()[0]
+            self.setpoint_order = None
+            self.setpoint_values = iter(self.feedback)
+            self.scan_shape = (len(self.feedback),)
+            self.scan_steps = len(self.feedback)
+        else:
+            if len(set(len(lst) for lst in values)) > 1:
+                raise ValueError('SimpleScan: all actuators need the same number of values, use "grid scan" instead')
+            setpoints = [tuple(lst[i] for lst in values) for i in range(len(values[0]))]
+            self.ordering = str(config['scan_params'].get('ordering', 'none'))
+            if 'order' in config['scan_params']:
+                self.setpoint_order = [int(i) for i in config['scan_params']['order']]
+            else:
+                self.setpoint_order = self.order_setpoints(actuators=actuators, setpoints=setpoints)
+            self.config['scan_params']['order'] = self.setpoint_order
+            self.setpoint_values = iter([((i,), setpoints[k]) for i, k in enumerate(self.setpoint_order)])
+            self.scan_shape = (len(setpoints),)
+            self.scan_steps = len(setpoints)
 
         # data channels:
-        self.data_channels = config['sensor']
+        self.data_channels = list(config['sensor'])
         for params in config['actuator']:
             self.data_channels += [params[key] for key in ['address_sp', 'address_rbv']]
 
         # scan params:
         scan_params = config['scan_params']
-        self.mode = bool(scan_params['mode'])
+        self.mode = str(scan_params['mode'])
+        self.go_to_best = bool(scan_params.get('go_to_best', 0)) and isinstance(self.feedback, OptimiserSetpoints)
         samples = int(scan_params['samples'])
+        self.samples = samples
         self.data_buffer = Buffer(channels=self.data_channels,
                                   size=samples,
-                                  stop_event=self.stop_event)
+                                  stop_event=self.stop_event,
+                                  catalog=self.catalog)
+        self.data_buffer.statistics = self.statistics
         background_samples = int(scan_params['background_samples'])
         if background_samples > 0:
             self.take_background = True
             self.background_buffer = Buffer(channels=self.data_channels,
                                             size=background_samples,
-                                            stop_event=self.stop_event)
+                                            stop_event=self.stop_event,
+                                            catalog=self.catalog)
         if 'facility' in scan_params: self.facility = scan_params['facility']
         else: self.facility = 'FLASH'
         if 'beamline' in scan_params: self.beamline = scan_params['beamline']
@@ -90,12 +168,62 @@ class SimpleScan(object):
         self.laser = Laser(facility=self.facility, beamline=self.beamline,
                            inhibit=np.invert(bool(scan_params['act_laser'])))
         file_tag = (str(scan_params['file_tag']) + '_' if 'file_tag' in scan_params else '')
-        dfilename = file_tag + datetime.now().replace(microsecond=0).isoformat() + '.h5'
+        dfilename = (self.filename if self.filename
+                     else file_tag + datetime.now().replace(microsecond=0).isoformat() + '.h5')
         if bool(scan_params['save']):
-            self.dfile = FLASHDataStruct(filename=dfilename, shape=(self.scan_steps, samples),
-                                         facility=self.facility, beamline=self.beamline)
+            self.dfile = FLASHDataStruct(filename=dfilename, shape=self.scan_shape + (samples,),
+                                         facility=self.facility, beamline=self.beamline,
+                                         storage=StoragePolicy(config.get('storage')), catalog=self.catalog)
         else: self.dfile = None
 
+    @classmethod
+    def resume(cls, filename: str, parent=None):
+        state = FLASHDataStruct(filename=filename).load_state()
+        print('Resuming {} ({}, last completed step {})'.format(filename, state['status'], state['step']))
+        scan = cls(config=json.loads(state['config']), parent=parent, filename=filename)
+        scan.restore(state)
+        return scan
+
+    def restore(self, state: dict):
+        self.background_done = state['background']
+        written = self.dfile.written_samples(channels=self.data_channels)
+        if written is None:
+            return
+        step, partial = 0, 0
+        while step < self.scan_steps:
+            try:
+                index, value = next(self.setpoint_values)
+            except StopIteration:
+                break
+            if written[index] < self.samples:
+                self.setpoint_values = chain([(index, value)], self.setpoint_values)
+                partial = int(written[index])
+                break
+            if not self.feedback is None:
+                data, macropulse = self.dfile.read_step(channel=self.signal, idx=index)
+                self.feedback.update(step=index[0],
+                                     samples=np.reshape(data, (len(data), -1)).mean(axis=1)[macropulse != 0])
+            step += 1
+        self.first_step = step
+        if partial:
+            for channel in self.data_channels:
+                data, macropulse = self.dfile.read_step(channel=channel, idx=index)
+                self.statistics.seed(step=index, channel=channel, samples=data[macropulse != 0])
+            self.sample_offset = partial
+            self.data_buffer.size = self.samples - partial
+        print('Resuming at step {} of {} (sample {})'.format(self.first_step, self.scan_steps, self.sample_offset))
+
+    def order_setpoints(self, actuators: list, setpoints: list):
+        order = SetpointOrder(actuators=actuators, method=self.ordering)
+        start = tuple(self.catalog.read(act.address_rbv)['data'] for act in actuators)
+        original = list(range(len(setpoints)))
+        t_before = order.tour_cost(setpoints, original, start)
+        indices = order.order(setpoints, start)
+        if indices != original:
+            print('Setpoint ordering ({}): predicted travel {:.1f} s -> {:.1f} s'.format(
+                self.ordering, t_before, order.tour_cost(setpoints, indices, start)))
+        return indices
+
     def next_step(self):
         try:
             flag = next(self.sequence)
@@ -107,38 +235,70 @@ class SimpleScan(object):
     def init_scan(self):
         print('Initializing scan...')
         self.stop_event.clear()
-        self.step_counter = -1
-        self.sequence = iter((['set'] if self.mode != 'manual' else [])
-                             + (['background'] if self.take_background else [])
-                             + reduce(lambda x, y: x + y,
-                                      repeat((['pause'] if self.mode != 'automatic' else [])
-                                             + ['collect', 'process']
-                                             + (['set'] if self.mode != 'manual' else []),
-                                             self.scan_steps))[:-1])
+        self.step_counter = self.first_step - 1
+        self.step_index = None
+        self.sequence = self.scan_sequence()
+        self.laser.refresh()
         self.laser.block
         self.next_step()
 
+    def scan_sequence(self):
+        if self.mode != 'manual': yield 'set'
+        if self.take_background and not self.background_done: yield 'background'
+        for step in range(self.first_step, self.scan_steps):
+            if self.mode != 'automatic': yield 'pause'
+            yield 'collect'
+            yield 'process'
+            if self.mode != 'manual' and step < self.scan_steps - 1: yield 'set'
+
+    def next_setpoint(self):
+        index, value = next(self.setpoint_values)
+        return index, self.actuator_value(value)
+
+    def actuator_value(self, value: tuple):
+        return list(value) if isinstance(self.actuator, ActuatorGroup) else value[0]
+
     def set_actuator(self):
         print('Setting new values...')
         try:
             self.laser.block
-            value = next(self.setpoint_values)
+            index, value = self.next_setpoint()
         except StopIteration:
             print('No more values!!!')
             self.flag = None
         else:
             self.actuator.set_value(target_value=value)
             self.step_counter += 1
+            self.step_index = index
+            self.record_step(value=value)
             self.laser.unblock
             self.next_step()
 
+    def record_step(self, value):
+        actuators = self.actuator.actuators if isinstance(self.actuator, ActuatorGroup) else [self.actuator]
+        settle_times = [np.nan if act.settle_time is None else act.settle_time for act in actuators]
+        print('Settle time: {}'.format(', '.join(['{:.2f} s'.format(t) for t in settle_times])))
+        self.data_buffer.tag = {'step': self.step_index, 'value': value}
+        values = {'setpoint': value, 'settle_time': settle_times, 'step_counter': self.step_counter}
+        if self.setpoint_order is not None:
+            values['original_index'] = self.setpoint_order[self.step_counter]
+        self.store_metadata(step=self.step_index, values=values)
+
+    def store_metadata(self, step: tuple = None, values: dict = None, attrs: dict = None):
+        if not self.writer is None and self.writer.is_alive():
+            self.writer.metadata(step=step, values=values, attrs=attrs)
+        elif not self.dfile is None:
+            self.dfile.dump_metadata(step=step, values=values, attrs=attrs)
+
     def collect_background(self):
         print('Taking background...')
         self.laser.block
         self.background_buffer.poll()
+        complete = self.background_buffer.queue.full() and not self.stop_event.is_set()
         while not self.background_buffer.queue.empty():
             data = self.background_buffer.queue.get()
-            if not self.dfile is None: self.dfile.dump(data_struct=data, grp_name='background')
+            if not self.writer is None: self.writer.submit(data_struct=data, grp_name='background')
+        if complete and not self.writer is None: self.writer.checkpoint(background=True)
         self.next_step()
 
     def collect_data(self):
@@ -148,17 +308,52 @@ class SimpleScan(object):
         self.laser.block
         self.next_step()
 
-    def process_data(self):
-        print('Processing data...')
-        i = 0
+    def step_data(self):
+        i = self.sample_offset
+        signal = []
         while not self.data_buffer.queue.empty():
             data = self.data_buffer.queue.get()
-            if not self.dfile is None: self.dfile.dump(data_struct=data, idx=(self.step_counter, i))
+            if not self.feedback is None:
+                signal += [np.mean(d['data']) for d in data['data'] if d['miscellaneous']['channel'] == self.signal]
+            yield data, self.step_index + (i,)
             i += 1
+        self.step_written = i
+        if self.sample_offset:
+            self.sample_offset = 0
+            self.data_buffer.size = self.samples
+        if not self.feedback is None and self.step_index is not None:
+            self.feedback.update(step=self.step_index[0], samples=signal)
+        if self.step_index is not None:
+            self.step_statistics = self.statistics.finish(self.step_index)
+
+    def step_checkpoint(self):
+        return {'step': self.step_counter, 'step_index': self.step_index, 'samples': self.step_written,
+                'statistics': self.step_statistics}
+
+    def hand_off(self):
+        for data, idx in self.step_data():
+            if not self.writer is None: self.writer.submit(data_struct=data, idx=idx)
+        if not self.writer is None and self.step_index is not None:
+            self.writer.checkpoint(**self.step_checkpoint())
+
+    def process_data(self):
+        print('Processing data...')
+        self.hand_off()
         self.next_step()
 
     def request_action(self):
         print('Requesting action...')
+        if self.mode == 'manual':
+            try:
+                index, value = self.next_setpoint()
+            except StopIteration:
+                print('No more values!!!')
+                self.flag = None
+                return
+            self.step_counter += 1
+            self.step_index = index
+            print('Manual step {}: {}'.format(index, value))
+            self.record_step(value=value)
         if not self.parent is None:
             action = self.parent.request_action(message='Do something and press OK.')
             if action:
@@ -180,17 +375,74 @@ class SimpleScan(object):
         self.next_step()
 
     def run(self):
-        self.init_scan()
-        while self.flag and not self.stop_event.is_set():
-            if self.flag == 'set': self.set_actuator()
-            elif self.flag == 'background': self.collect_background()
-            elif self.flag == 'pause': self.request_action()
-            elif self.flag == 'collect': self.collect_data()
-            elif self.flag == 'process': self.process_data()
-            else: return
-        print('Scan finished!')
+        try:
+            self.init_scan()
+            with (self.dfile if not self.dfile is None else nullcontext()):
+                if not self.dfile is None:
+                    self.prepare_file()
+                    self.writer = DataWriter(dfile=self.dfile,
+                                             size=max(DataWriter.QUEUE_SIZE, 2 * self.data_buffer.size))
+                    self.writer.start()
+                status = 'failed'
+                try:
+                    while self.flag and not self.stop_event.is_set():
+                        if self.flag == 'set': self.set_actuator()
+                        elif self.flag == 'background': self.collect_background()
+                        elif self.flag == 'pause': self.request_action()
+                        elif self.flag == 'collect': self.collect_data()
+                        elif self.flag == 'process': self.process_data()
+                        else: break
+                    status = 'aborted' if self.stop_event.is_set() else 'finished'
+                finally:
+                    if not self.writer is None:
+                        self.writer.stop()
+                        print('Data writer: {}'.format(self.writer.stats))
+                    if not self.dfile is None:
+                        self.dfile.dump_attrs(grp_name='METADATA', status=status)
+                    self.laser.gate.close()
+                if isinstance(self.feedback, OptimiserSetpoints):
+                    best = self.finish_optimisation()
+                    if self.go_to_best and best is not None and not self.stop_event.is_set():
+                        self.actuator.set_value(target_value=self.actuator_value(best))
+            print('Scan finished!')
+            print('Timing configuration cache: {}'.format(timing_config.stats))
+            print('Waits: {}'.format(wait_stats.stats))
+            print('Laser transitions: {}'.format(self.laser.gate.stats))
+            if self.data_buffer.taps:
+                print('Live taps: {} bundles dropped'.format(self.data_buffer.dropped))
+        finally:
+            self.shutdown()
         return
 
+    def prepare_file(self):
+        self.dfile.prepare(channels=self.data_channels, grp_name='DATA')
+        self.dfile.dump_attrs(grp_name='METADATA', ordering=self.ordering, config=json.dumps(self.config),
+                              status='running')
+        if self.take_background:
+            if not self.background_done:
+                self.dfile.truncate(grp_name='BACKGROUND')
+            self.dfile.prepare(channels=self.data_channels, grp_name='BACKGROUND', append=True)
+
+    def finish_optimisation(self):
+        best = self.feedback.best
+        if best is None:
+            return None
+        value = self.feedback.points[best]
+        print('Optimisation: best {} = {} at {}'.format(self.signal, self.feedback.measured(best), value))
+        self.store_metadata(attrs={'best_step': best, 'best_setpoint': value,
+                                   'best_value': self.feedback.measured(best), 'signal': self.signal})
+        if self.go_to_best:
+            print('Moving to best setpoint {}'.format(value))
+        return value
+
+    def shutdown(self):
+        for buffer in [self.data_buffer, self.background_buffer]:
+            if not buffer is None:
+                buffer.shutdown()
+        if isinstance(self.actuator, ActuatorGroup):
+            self.actuator.shutdown()
+        self.catalog.reader.shutdown()
+
     def threaded_start(self):
         thread = Thread(target=self.run, daemon=True)
         thread.start()
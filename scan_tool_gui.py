@@ -15,12 +15,10 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
-try:
-    import pydoocs
-except Exception as err:
-    print(err)
-    pass
-
+import control_system
+from control_system import pydoocs
+from actuator_classes import ActuatorGroup
+from monitor_classes import StepMonitor
 from scan_classes import SimpleScan
 
 
@@ -75,7 +73,10 @@ class ConfigBox(QGroupBox):
         self.scan_type = QComboBox(self)
         self.scan_type.setObjectName("scan_type")
         self.scan_type.addItems(['fixed-point',
-                                 'simple scan'])
+                                 'simple scan',
+                                 'grid scan',
+                                 'adaptive scan',
+                                 'optimisation scan'])
         self.scan_type.setCurrentText('simple scan')
         self.op_mode = QComboBox(self)
         self.op_mode.setObjectName("mode")
@@ -221,7 +222,7 @@ class ConfigBox(QGroupBox):
         self.abort_scan_pb.setStyleSheet('background-color: #FCC4C4')
         self.scan_type.setEnabled(True)
         self.samples_per_step.setEnabled(True)
-        if self.scan.scan_type == 'simple scan':
+        if self.scan_type.currentText() != 'fixed-point':
             self.op_mode.setEnabled(True)
             self.scan_steps.setEnabled(True)
         self.save_file_cb.setEnabled(True)
@@ -644,11 +645,16 @@ class SensorBox(QGroupBox):
 
 class Plot(QWidget):
 
-    def __init__(self, parent, scan):
+    FRAME_RATE = 5
+
+    def __init__(self, parent):
         super().__init__(parent)
-        self.scan = scan
+        self.monitor = None
         self.setMaximumSize(550, 550)
         self.s1 = pg.ScatterPlotItem(size=5, pen=pg.mkPen((0, 100, 200)), brush=None)
+        self.mean = pg.PlotDataItem(pen=pg.mkPen((200, 50, 0), width=2), symbol='o', symbolSize=7,
+                                    symbolBrush=(200, 50, 0))
+        self.error = pg.ErrorBarItem(x=np.array([]), y=np.array([]), pen=pg.mkPen((200, 50, 0)), beam=0)
         self.plot_window = pg.GraphicsLayoutWidget()
         self.plot = self.plot_window.addPlot(0, 0, 1)
         self.plot.setMaximumSize(500, 500)
@@ -656,9 +662,40 @@ class Plot(QWidget):
         self.plot.getAxis('bottom').setLabel(text='ActuatorGroup target_value')
         self.plot.getAxis('left').setLabel(text='Sensor target_value')
         self.plot.addItem(self.s1)
+        self.plot.addItem(self.error)
+        self.plot.addItem(self.mean)
         layout = QHBoxLayout()
         layout.addWidget(self.plot_window)
         self.setLayout(layout)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def attach(self, scan):
+        self.detach()
+        actuator = scan.actuator.actuators[0] if isinstance(scan.actuator, ActuatorGroup) else scan.actuator
+        channel = scan.signal if scan.signal is not None else scan.data_channels[0]
+        self.monitor = StepMonitor(channel=channel, statistics=scan.statistics)
+        self.monitor.attach(scan.data_buffer)
+        self.plot.getAxis('bottom').setLabel(text=actuator.address_sp)
+        self.plot.getAxis('left').setLabel(text=channel)
+        self.s1.clear()
+        self.mean.clear()
+        self.error.setData(x=np.array([]), y=np.array([]), height=np.array([]))
+        self.timer.start(int(1000 / self.FRAME_RATE))
+
+    def detach(self):
+        self.timer.stop()
+        if self.monitor is not None:
+            self.monitor.detach()
+
+    def refresh(self):
+        if not self.monitor.drain():
+            return
+        x, y = self.monitor.scatter()
+        self.s1.setData(x=x, y=y)
+        x, mean, std = self.monitor.curve()
+        self.mean.setData(x=x, y=mean)
+        self.error.setData(x=x, y=mean, height=2 * std)
 
 
 class Gui(QWidget):
@@ -671,7 +708,7 @@ class Gui(QWidget):
         self.config_box = ConfigBox(parent=self)
         self.actuator_box = ActuatorBox(parent=self)
         self.sensor_box = SensorBox(parent=self)
-        #self.plot = Plot(self, scan)
+        self.plot = Plot(self)
         self.scan = None
         self._scan_thread = None
 
@@ -679,7 +716,7 @@ class Gui(QWidget):
         layout.addWidget(self.config_box, 0, 0)
         layout.addWidget(self.actuator_box, 1, 0)
         layout.addWidget(self.sensor_box, 2, 0)
-        #layout.addWidget(self.plot, 0, 1, 2, 1)
+        layout.addWidget(self.plot, 0, 1, 3, 1)
 
         self.config_box.start_scan_pb.pressed.connect(self.init_scan)
         self.config_box.abort_scan_pb.pressed.connect(self.abort_scan)
@@ -706,6 +743,7 @@ class Gui(QWidget):
                       'sensor': self.sensor_box.parse()}
             try:
                 self.scan = SimpleScan(config=config, parent=self)
+                self.plot.attach(self.scan)
                 self._scan_thread = Thread(target=self.scan.run, daemon=True)
                 self._scan_thread.start()
                 #self.scan.threaded_start()
@@ -733,7 +771,12 @@ class Gui(QWidget):
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    parser = ArgumentParser(description='Scan tool GUI')
+    parser.add_argument('--simulator', action='store_true', help='run against the local machine simulator')
+    args, qt_args = parser.parse_known_args()
+    if args.simulator:
+        control_system.use_simulator()
+    app = QApplication(sys.argv[:1] + qt_args)
     myapp = Gui(None)
     ssFile = './stylesheet_white.css'
     with open(ssFile, "r") as fh:
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import time
+
+
+class SetpointOrder(object):
+
+    METHODS = ['none', 'sorted', 'greedy']
+    MAX_TWO_OPT = 200
+    TIME_BUDGET = 2.0
+
+    def __init__(self, actuators: list, method: str = 'greedy'):
+        if method not in self.METHODS:
+            raise ValueError('SetpointOrder: unknown ordering {}, use one of {}'.format(method, self.METHODS))
+        self.actuators = actuators
+        self.method = method
+
+    def cost(self, start: tuple, target: tuple):
+        return max(act.estimate_move(a, b) for act, a, b in zip(self.actuators, start, target))
+
+    def tour_cost(self, setpoints: list, order: list, start: tuple):
+        total, position = 0.0, start
+        for i in order:
+            total += self.cost(position, setpoints[i])
+            position = setpoints[i]
+        return total
+
+    def order(self, setpoints: list, start: tuple):
+        if self.method == 'none' or len(setpoints) < 3:
+            return list(range(len(setpoints)))
+        if self.method == 'sorted':
+            descending = [act.approach == 'down' for act in self.actuators]
+            return sorted(range(len(setpoints)),
+                          key=lambda i: tuple(-v if d else v for v, d in zip(setpoints[i], descending)))
+        order = self._greedy(setpoints, start)
+        if len(order) <= self.MAX_TWO_OPT:
+            order = self._two_opt(setpoints, order, start)
+        return order
+
+    def _greedy(self, setpoints: list, start: tuple):
+        remaining = set(range(len(setpoints)))
+        order, position = [], start
+        while remaining:
+            nearest = min(remaining, key=lambda i: (self.cost(position, setpoints[i]), i))
+            remaining.remove(nearest)
+            order.append(nearest)
+            position = setpoints[nearest]
+        return order
+
+    def _two_opt(self, setpoints: list, order: list, start: tuple):
+        best = self.tour_cost(setpoints, order, start)
+        t_stop = time.monotonic() + self.TIME_BUDGET
+        improved = True
+        while improved and time.monotonic() < t_stop:
+            improved = False
+            for i in range(len(order) - 1):
+                for j in range(i + 2, len(order) + 1):
+                    candidate = order[:i] + order[i:j][::-1] + order[j:]
+                    cost = self.tour_cost(setpoints, candidate, start)
+                    if cost < best - 1e-9:
+                        order, best, improved = candidate, cost, True
+                if time.monotonic() > t_stop:
+                    break
+        return order
+
+
+class SetpointGrid(object):
+
+    def __init__(self, axes: list, serpentine: bool = True):
+        self.axes = [list(axis) for axis in axes]
+        self.shape = tuple(len(axis) for axis in self.axes)
+        self.serpentine = serpentine
+
+    def __len__(self):
+        size = 1
+        for n in self.shape:
+            size *= n
+        return size
+
+    def index(self, step: int):
+        digits = []
+        for n in reversed(self.shape):
+            step, digit = divmod(step, n)
+            digits.append(digit)
+        digits.reverse()
+        if not self.serpentine:
+            return tuple(digits)
+        index, outer = [], 0
+        for digit, n in zip(digits, self.shape):
+            index.append(n - 1 - digit if outer % 2 else digit)
+            outer = outer * n + digit
+        return tuple(index)
+
+    def value(self, index: tuple):
+        return tuple(axis[i] for axis, i in zip(self.axes, index))
+
+    def __iter__(self):
+        for step in range(len(self)):
+            index = self.index(step)
+            yield index, self.value(index)
+
+
+class MeasuredSetpoints(object):
+
+    RESOLUTION = 0.01
+
+    def __init__(self, axes: list, budget: int, resolution: float = None):
+        self.axes = [list(axis) for axis in axes]
+        self.budget = int(budget)
+        self.resolution = self.RESOLUTION if resolution is None else resolution
+        self.lower = np.array([min(axis) for axis in self.axes], dtype=float)
+        self.span = np.array([max(axis) - min(axis) for axis in self.axes], dtype=float)
+        self.span[self.span == 0] = 1.0
+        self.points = []
+        self.mean = []
+        self.error = []
+
+    def __len__(self):
+        return self.budget
+
+    def normalise(self, value: tuple):
+        return (np.asarray(value, dtype=float) - self.lower) / self.span
+
+    def denormalise(self, x: np.ndarray):
+        return tuple(float(v) for v in np.clip(x, 0.0, 1.0) * self.span + self.lower)
+
+    def update(self, step: int, samples: list):
+        samples = np.asarray(samples, dtype=float)
+        samples = samples[np.isfinite(samples)]
+        while len(self.mean) <= step:
+            self.mean.append(np.nan)
+            self.error.append(np.nan)
+        if len(samples):
+            self.mean[step] = samples.mean()
+            self.error[step] = samples.std() / np.sqrt(len(samples)) if len(samples) > 1 else 0.0
+
+    def measured(self, step: int):
+        return self.mean[step] if step < len(self.mean) else np.nan
+
+
+class AdaptiveSetpoints(MeasuredSetpoints):
+
+    def __init__(self, axes: list, budget: int, resolution: float = None):
+        super().__init__(axes=axes, budget=budget, resolution=resolution)
+        self.coarse = SetpointGrid(axes=axes, serpentine=True)
+
+    def candidate(self):
+        measured = [i for i in range(len(self.points)) if np.isfinite(self.measured(i))]
+        if len(measured) < 2:
+            return None
+        x = np.array([self.normalise(self.points[i]) for i in measured])
+        y = np.array([self.mean[i] for i in measured])
+        err = np.array([self.error[i] for i in measured])
+        scale = np.ptp(y) or 1.0
+        known = set(self.points)
+        dist = np.sqrt(((x[:, None, :] - x[None, :, :]) ** 2).sum(axis=2))
+        k = min(2 * x.shape[1], len(measured) - 1)
+        edges = set()
+        for i in range(len(measured)):
+            for j in np.argsort(dist[i])[1:k + 1]:
+                edges.add((min(i, j), max(i, j)))
+        best, best_loss = None, -np.inf
+        for i, j in edges:
+            if dist[i, j] < 2 * self.resolution:
+                continue
+            loss = np.hypot(dist[i, j], (y[i] - y[j]) / scale) + (err[i] + err[j]) / scale
+            value = self.denormalise((x[i] + x[j]) / 2)
+            if loss > best_loss and value not in known:
+                best, best_loss = value, loss
+        return best
+
+    def __iter__(self):
+        for step, (index, value) in enumerate(self.coarse):
+            if step >= self.budget:
+                return
+            self.points.append(value)
+            yield (step,), value
+        for step in range(len(self.points), self.budget):
+            value = self.candidate()
+            if value is None:
+                print('Adaptive scan: resolution reached after {} steps'.format(step))
+                return
+            self.points.append(value)
+            yield (step,), value
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class OptimiserSetpoints(MeasuredSetpoints):
+
+    STEP = 0.1
+    REFLECTION = 1.0
+    EXPANSION = 2.0
+    CONTRACTION = 0.5
+    SHRINK = 0.5
+
+    def __init__(self, axes: list, budget: int, start: tuple = None, step: float = None, goal: str = 'max',
+                 resolution: float = None):
+        super().__init__(axes=axes, budget=budget, resolution=resolution)
+        if goal not in ['max', 'min']:
+            raise ValueError('OptimiserSetpoints: goal must be "max" or "min"!!!')
+        self.goal = goal
+        self.step = self.STEP if step is None else step
+        self.start = self.normalise(start if start is not None else [axis[0] for axis in self.axes])
+
+    def cost(self, step: int):
+        value = self.measured(step)
+        if not np.isfinite(value):
+            return np.inf
+        return -value if self.goal == 'max' else value
+
+    @property
+    def best(self):
+        costs = [self.cost(step) for step in range(len(self.points))]
+        if not costs or not np.isfinite(min(costs)):
+            return None
+        return int(np.argmin(costs))
+
+    def evaluate(self, x: np.ndarray):
+        value = self.denormalise(x)
+        if value in self.points:
+            step = self.points.index(value)
+        else:
+            if len(self.points) >= self.budget:
+                raise BudgetExhausted
+            step = len(self.points)
+            self.points.append(value)
+            yield (step,), value
+        return self.cost(step)
+
+    def search(self):
+        dim = len(self.axes)
+        x0 = np.clip(self.start, 0.0, 1.0)
+        simplex = [x0]
+        for i in range(dim):
+            x = x0.copy()
+            x[i] += self.step if x[i] + self.step <= 1.0 else -self.step
+            simplex.append(x)
+        costs = []
+        for x in simplex:
+            costs.append((yield from self.evaluate(x)))
+        while True:
+            order = np.argsort(costs)
+            simplex, costs = [simplex[i] for i in order], [costs[i] for i in order]
+            if max(np.abs(x - simplex[0]).max() for x in simplex[1:]) < self.resolution:
+                print('Optimisation: converged after {} evaluations'.format(len(self.points)))
+                return
+            centroid = np.mean(simplex[:-1], axis=0)
+            reflected = np.clip(centroid + self.REFLECTION * (centroid - simplex[-1]), 0.0, 1.0)
+            cost_r = yield from self.evaluate(reflected)
+            if cost_r < costs[0]:
+                expanded = np.clip(centroid + self.EXPANSION * (reflected - centroid), 0.0, 1.0)
+                cost_e = yield from self.evaluate(expanded)
+                simplex[-1], costs[-1] = (expanded, cost_e) if cost_e < cost_r else (reflected, cost_r)
+            elif cost_r < costs[-2]:
+                simplex[-1], costs[-1] = reflected, cost_r
+            else:
+                contracted = np.clip(centroid + self.CONTRACTION * (simplex[-1] - centroid), 0.0, 1.0)
+                cost_c = yield from self.evaluate(contracted)
+                if cost_c < costs[-1]:
+                    simplex[-1], costs[-1] = contracted, cost_c
+                else:
+                    for i in range(1, len(simplex)):
+                        simplex[i] = simplex[0] + self.SHRINK * (simplex[i] - simplex[0])
+                        costs[i] = yield from self.evaluate(simplex[i])
+
+    def __iter__(self):
+        try:
+            yield from self.search()
+        except BudgetExhausted:
+            print('Optimisation: budget of {} evaluations exhausted'.format(self.budget))
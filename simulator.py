@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from datetime import datetime
+from fnmatch import fnmatch
+import numpy as np
+import re
+import time
+from threading import Event, Lock, Thread
+import zlib
+
+
+class DoocsException(Exception):
+    pass
+
+
+class PyDaqException(Exception):
+    pass
+
+
+class SimMagnet(object):
+
+    def __init__(self, current: float = 0.0, ramp_rate: float = 10.0, polwende_time: float = 3.0,
+                 noise: float = 0.005):
+        self.ramp_rate = ramp_rate
+        self.polwende_time = polwende_time
+        self.noise = noise
+        self.ps_on = True
+        self.target = current
+        self._segments = [(time.monotonic(), current, current, 0.0)]
+
+    def set(self, target: float):
+        now = time.monotonic()
+        current = self.value(now)
+        self.target = target
+        if current * target < 0:
+            t_zero = now + abs(current) / self.ramp_rate
+            t_switched = t_zero + self.polwende_time
+            self._segments = [(now, current, 0.0, t_zero),
+                              (t_zero, 0.0, 0.0, t_switched),
+                              (t_switched, 0.0, target, t_switched + abs(target) / self.ramp_rate)]
+        else:
+            self._segments = [(now, current, target, now + abs(target - current) / self.ramp_rate)]
+
+    def value(self, t: float = None):
+        t = time.monotonic() if t is None else t
+        for t_start, v_start, v_stop, t_stop in self._segments:
+            if t < t_stop:
+                if t < t_start or t_stop == t_start:
+                    return v_start
+                return v_start + (v_stop - v_start) * (t - t_start) / (t_stop - t_start)
+        return self._segments[-1][2]
+
+    def idle(self, t: float = None):
+        t = time.monotonic() if t is None else t
+        return t >= self._segments[-1][3]
+
+
+class SimDevice(object):
+
+    def __init__(self, value: float = 0.0, tau: float = 0.5, noise: float = 0.001):
+        self.tau = tau
+        self.noise = noise
+        self.target = value
+        self._start = value
+        self._t_write = time.monotonic()
+
+    def set(self, target: float):
+        self._start = self.value()
+        self.target = target
+        self._t_write = time.monotonic()
+
+    def value(self, t: float = None):
+        t = time.monotonic() if t is None else t
+        return self.target + (self._start - self.target) * np.exp(-(t - self._t_write) / self.tau)
+
+
+class SimDaq(object):
+
+    PyDaqException = PyDaqException
+    MAX_EVENTS = 10000
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self._events = None
+        self._chans = []
+        self._local = True
+
+    def connect(self, start: str, stop: str, chans: list, exp: str = None, ddir: str = None, local: bool = True):
+        try:
+            duration = (datetime.fromisoformat(stop) - datetime.fromisoformat(start)).total_seconds()
+        except Exception as err:
+            raise PyDaqException('SimDaq: cannot parse time range ({})'.format(err))
+        if duration <= 0:
+            raise PyDaqException('SimDaq: empty time range!!!')
+        n_events = min(int(duration * self.simulator.rep_rate), self.MAX_EVENTS)
+        first = self.simulator.macropulse() - n_events
+        self._events = iter(range(first, first + n_events))
+        self._chans = list(chans)
+        self._local = local
+
+    def getdata(self):
+        if self._events is None:
+            raise PyDaqException('SimDaq: not connected!!!')
+        try:
+            macropulse = next(self._events)
+        except StopIteration:
+            return None
+        timestamp = self.simulator.macropulse_time(macropulse)
+        if self._local:
+            out = []
+            for chan in self._chans:
+                data = self.simulator.payload(chan)
+                if isinstance(data, np.ndarray) and data.ndim == 2:
+                    subchan = {'data': data, 'type': 'IMAGE'}
+                else:
+                    subchan = {'data': [(0, data)], 'type': 'A_USTR'}
+                subchan.update({'macropulse': macropulse, 'timestamp': timestamp,
+                                'miscellaneous': {'daqname': chan}})
+                out.append([subchan])
+            return out
+        return [{'data': [(0, self.simulator.payload(chan))], 'type': 'A_USTR', 'macropulse': macropulse,
+                 'timestamp': timestamp, 'miscellaneous': {'daqname': chan}} for chan in self._chans]
+
+    def disconnect(self):
+        self._events = None
+
+
+class MachineSimulator(object):
+
+    DoocsException = DoocsException
+    TIMER = 'FLASH.DIAG/TIMER/FLASHCPUTIME1.0/'
+    LASER = 'FLASH.DIAG/LASER.CONTROL/LASER'
+    MAGNET = re.compile(r'(FLASH\.MAGNETS/MAGNET\.ML/[A-Z0-9]+)/([A-Z_.]+)$')
+    DIVIDERS = {1.0: 8, 2.0: 4, 5.0: 2, 10.0: 1}
+    SPECTRUM_PIXELS = 1024
+
+    def __init__(self, rep_rate: float = 10.0, latency: float = 0.002, jitter: float = 0.001,
+                 ramp_rate: float = 10.0, polwende_time: float = 3.0, laser_delay: float = 0.2,
+                 seed: int = None):
+        self.rep_rate = rep_rate
+        self.default_latency = (latency, jitter)
+        self.latency = {'*/SPECTRUM*': (10 * latency, 5 * jitter),
+                        '*/IMAGE*': (50 * latency, 10 * jitter)}
+        self.ramp_rate = ramp_rate
+        self.polwende_time = polwende_time
+        self.laser_delay = laser_delay
+        self.rng = np.random.default_rng(seed)
+        self.destination_select = {1: 4, 2: 2, 3: 8}
+        self.laser_select = {1: 1, 2: 2, 3: 2}
+        self.magnets = {}
+        self.devices = {}
+        self.lasers = {1: [False, False, 0.0], 2: [False, False, 0.0]}
+        self.unavailable = set()
+        self.optimum = {}
+        self.lag = {}
+        self.reads = 0
+        self.writes = 0
+        self.daq = SimDaq(self)
+        self.subscriptions = {}
+        self._t0 = time.monotonic()
+        self._wall0 = time.time()
+        self._m0 = 1000000
+        self._lock = Lock()
+
+    # machine clock
+    def macropulse(self, t: float = None):
+        t = time.monotonic() if t is None else t
+        return self._m0 + int((t - self._t0) * self.rep_rate)
+
+    def macropulse_time(self, macropulse: int):
+        return self._wall0 + (macropulse - self._m0) / self.rep_rate
+
+    def set_rep_rate(self, rep_rate: float):
+        if rep_rate not in self.DIVIDERS:
+            raise ValueError('MachineSimulator: rep. rate must be one of {}'.format(list(self.DIVIDERS)))
+        with self._lock:
+            m_curr = self.macropulse()
+            self._t0 = time.monotonic()
+            self._wall0 = time.time()
+            self._m0 = m_curr
+            self.rep_rate = rep_rate
+
+    # configuration
+    def set_latency(self, pattern: str, latency: float, jitter: float = 0.0):
+        self.latency[pattern] = (latency, jitter)
+
+    def add_magnet(self, name: str, current: float = 0.0, **kwargs):
+        params = {'ramp_rate': self.ramp_rate, 'polwende_time': self.polwende_time}
+        params.update(kwargs)
+        self.magnets[name] = SimMagnet(current=current, **params)
+        return self.magnets[name]
+
+    def add_device(self, address_sp: str, address_rbv: str = None, value: float = 0.0, **kwargs):
+        device = SimDevice(value=value, **kwargs)
+        self.devices[address_sp] = device
+        if address_rbv:
+            self.devices[address_rbv] = device
+        return device
+
+    def fail(self, address: str):
+        self.unavailable.add(address)
+
+    # pydoocs interface
+    def read(self, address: str):
+        self._sleep(address)
+        self.reads += 1
+        if address in self.unavailable:
+            raise DoocsException('MachineSimulator: channel {} not available!!!'.format(address))
+        m_curr = self.macropulse()
+        data, dtype, macropulse = self._read(address, m_curr)
+        return {'data': data,
+                'macropulse': macropulse,
+                'miscellaneous': {},
+                'timestamp': self.macropulse_time(m_curr),
+                'type': dtype}
+
+    def write(self, address: str, value):
+        self._sleep(address)
+        self.writes += 1
+        if address in self.unavailable:
+            raise DoocsException('MachineSimulator: channel {} not available!!!'.format(address))
+        with self._lock:
+            match = self.MAGNET.match(address)
+            if match:
+                magnet = self._magnet(match.group(1))
+                if match.group(2).endswith('.SP'):
+                    if not magnet.ps_on:
+                        raise DoocsException('MachineSimulator: magnet {} is off!!!'.format(match.group(1)))
+                    magnet.set(float(value))
+                elif match.group(2) == 'PS_ON':
+                    magnet.ps_on = bool(value)
+                return
+            if address.startswith(self.LASER) and address.endswith('/BLOCK_LASER'):
+                laser = self.lasers[int(address[len(self.LASER)])]
+                laser[1] = bool(value)
+                laser[2] = time.monotonic() + self.laser_delay
+                return
+            if address.startswith(self.TIMER):
+                prop = address[len(self.TIMER):]
+                if prop.startswith('DESTINATION_SELECT.'):
+                    self.destination_select[int(prop.split('.')[1])] = int(value)
+                elif prop.startswith('LASER_SELECT.'):
+                    self.laser_select[int(prop.split('.')[1])] = int(value)
+                return
+            if address not in self.devices:
+                self.add_device(address, re.sub(r'SP$', 'RBV', address), value=float(value))
+            self.devices[address].set(float(value))
+
+    def subscribe(self, address: str, callback):
+        if address in self.subscriptions:
+            raise DoocsException('MachineSimulator: {} already subscribed!!!'.format(address))
+        stop_event = Event()
+        thread = Thread(target=self._publish, args=(address, callback, stop_event), daemon=True)
+        self.subscriptions[address] = stop_event
+        thread.start()
+
+    def unsubscribe(self, address: str):
+        stop_event = self.subscriptions.pop(address, None)
+        if stop_event is not None:
+            stop_event.set()
+
+    # internals
+    def _publish(self, address: str, callback, stop_event: Event):
+        while not stop_event.is_set():
+            m_next = self.macropulse() + 1
+            delay = self._t0 + (m_next - self._m0) / self.rep_rate - time.monotonic()
+            if stop_event.wait(max(delay, 0.0)):
+                return
+            m_curr = self.macropulse()
+            data, dtype, macropulse = self._read(address, m_curr)
+            try:
+                callback({'data': data,
+                          'macropulse': macropulse,
+                          'miscellaneous': {},
+                          'timestamp': self.macropulse_time(m_curr),
+                          'type': dtype})
+            except Exception as err:
+                print('MachineSimulator: subscription callback error ({})'.format(err))
+
+    def _sleep(self, address: str):
+        latency, jitter = self.default_latency
+        for pattern, params in self.latency.items():
+            if fnmatch(address, pattern):
+                latency, jitter = params
+        delay = latency + jitter * abs(self.rng.standard_normal())
+        if delay > 0:
+            time.sleep(delay)
+
+    def _magnet(self, name: str):
+        if name not in self.magnets:
+            self.add_magnet(name)
+        return self.magnets[name]
+
+    def _beam_on(self):
+        laser = self.laser_select.get(self._bunch_train_part(), 1)
+        blocked, requested, t_switch = self.lasers[laser]
+        if time.monotonic() >= t_switch:
+            blocked = requested
+            self.lasers[laser][0] = blocked
+        return not blocked
+
+    def _bunch_train_part(self):
+        for btp, destination in self.destination_select.items():
+            if destination == 8:
+                return btp
+        return 1
+
+    def _figure_of_merit(self):
+        if not self.magnets:
+            return 1.0
+        offsets = [(magnet.value() - self.optimum.get(name, -22.0)) / 5.0 for name, magnet in self.magnets.items()]
+        return float(np.exp(-0.5 * np.sum(np.square(offsets))))
+
+    def _seed(self, address: str):
+        return (zlib.crc32(address.encode()) % 1000) / 1000.0
+
+    def payload(self, address: str):
+        beam = self._beam_on()
+        fom = self._figure_of_merit() if beam else 0.0
+        if 'SPECTRUM' in address:
+            x = np.arange(self.SPECTRUM_PIXELS, dtype=float)
+            centre = self.SPECTRUM_PIXELS * (0.3 + 0.4 * self._seed(address))
+            y = 1000.0 * fom * np.exp(-0.5 * ((x - centre) / 40.0) ** 2)
+            y += self.rng.normal(10.0, 2.0, self.SPECTRUM_PIXELS)
+            return np.stack([x, y], axis=1)
+        if 'IMAGE' in address:
+            return self.rng.poisson(5.0 + 50.0 * fom, (256, 256)).astype(np.uint16)
+        if 'CHARGE' in address:
+            return float(0.5 * fom + self.rng.normal(0.0, 0.005))
+        if '/BPM/' in address:
+            if not beam:
+                return float(self.rng.normal(0.0, 0.5))
+            offset = sum(magnet.value() for magnet in self.magnets.values())
+            return float(0.02 * (2 * self._seed(address) - 1) * offset + self.rng.normal(0.0, 0.01))
+        return float(self._seed(address) + self.rng.normal(0.0, 0.001))
+
+    def _read(self, address: str, m_curr: int):
+        if address.startswith(self.TIMER):
+            prop = address[len(self.TIMER):]
+            if prop == 'MACRO_PULSE_NUMBER':
+                return np.array([m_curr, 0], dtype=np.int64), 'A_INT', 0
+            if prop.startswith('DESTINATION_SELECT.'):
+                return self.destination_select[int(prop.split('.')[1])], 'INT', 0
+            if prop.startswith('LASER_SELECT.'):
+                return self.laser_select[int(prop.split('.')[1])], 'INT', 0
+            if prop.startswith('EVENT'):
+                return np.array([0, 0, 0, self.DIVIDERS[self.rep_rate]], dtype=np.int64), 'A_INT', 0
+        match = self.MAGNET.match(address)
+        if match:
+            magnet = self._magnet(match.group(1))
+            prop = match.group(2)
+            if prop.endswith('.SP'):
+                return magnet.target, 'FLOAT', 0
+            if prop.endswith('.RBV'):
+                return magnet.value() + self.rng.normal(0.0, magnet.noise), 'FLOAT', 0
+            if prop == 'PS_ON':
+                return int(magnet.ps_on), 'INT', 0
+            if prop == 'PS_IDLE':
+                return int(magnet.idle()), 'INT', 0
+        if address.startswith(self.LASER) and address.endswith('/BLOCK_LASER'):
+            self._beam_on()
+            return int(self.lasers[int(address[len(self.LASER)])][0]), 'INT', 0
+        if address in self.devices:
+            device = self.devices[address]
+            return device.value() + self.rng.normal(0.0, device.noise), 'FLOAT', 0
+        data = self.payload(address)
+        dtype = 'SPECTRUM' if 'SPECTRUM' in address else ('IMAGE' if 'IMAGE' in address else 'FLOAT')
+        return data, dtype, m_curr - self.lag.get(address, 0)
+
+
+if __name__ == "__main__":
+    import cProfile
+    import json
+    import pstats
+
+    parser = ArgumentParser(description='Run a scan configuration against the machine simulator.')
+    parser.add_argument('config', help='scan configuration file (e.g. templates/test.json), or the HDF5 file '
+                                       'of an interrupted scan with --resume')
+    parser.add_argument('--resume', action='store_true', help='resume the interrupted scan stored in config')
+    parser.add_argument('--rep-rate', type=float, default=10.0)
+    parser.add_argument('--latency', type=float, default=0.002, help='mean read latency per channel [s]')
+    parser.add_argument('--jitter', type=float, default=0.001, help='read latency jitter [s]')
+    parser.add_argument('--ramp-rate', type=float, default=10.0, help='magnet ramp rate [A/s]')
+    parser.add_argument('--polwende-time', type=float, default=3.0, help='magnet polarity switch duration [s]')
+    parser.add_argument('--no-subscribe', action='store_true', help='hide subscriptions, forcing polled triggers')
+    parser.add_argument('--asyncio', action='store_true', help='run the scan on the asyncio engine')
+    parser.add_argument('--profile', action='store_true', help='run the scan under cProfile')
+    parser.add_argument('--top', type=int, default=25, help='number of profile entries to print')
+    args = parser.parse_args()
+
+    import control_system
+    sim = control_system.use_simulator(rep_rate=args.rep_rate, latency=args.latency, jitter=args.jitter,
+                                       ramp_rate=args.ramp_rate, polwende_time=args.polwende_time)
+    if args.no_subscribe:
+        sim.subscribe = None
+    from scan_classes import SimpleScan
+    from async_scan_classes import AsyncScan
+
+    engine = AsyncScan if args.asyncio else SimpleScan
+    if args.resume:
+        scan = engine.resume(filename=args.config)
+    else:
+        with open(args.config, 'r') as jf:
+            config = json.load(jf)
+        scan = engine(config=config)
+    t_start = time.perf_counter()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(scan.run)
+    else:
+        scan.run()
+    t_stop = time.perf_counter()
+    print('Scan time: {:.2f} s, {} reads, {} writes'.format(t_stop - t_start, sim.reads, sim.writes))
+    if args.profile:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.top)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+import os
+import tempfile
+import time
+
+from data_classes import FLASHDataStruct, StoragePolicy
+from simulator import MachineSimulator
+
+
+POLICIES = {'contiguous': {},
+            'lzf': {'default': {'compression': 'lzf'}},
+            'lzf+shuffle': {'default': {'compression': 'lzf', 'shuffle': 1}},
+            'gzip4': {'default': {'compression': 'gzip', 'compression_opts': 4}},
+            'gzip4+shuffle': {'default': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': 1}},
+            'gzip4+shuffle+float32': {'default': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': 1,
+                                                  'dtype': 'float32'}}}
+
+CHANNELS = ['FLASH.DIAG/BPM/2FLFMAFF/X.FLASH3',
+            'FLASH.DIAG/BPM/2FLFMAFF/Y.FLASH3',
+            'FLASH.DIAG/TOROID/7FLFMAFF/CHARGE.FLASH3',
+            'FLASH.DIAG/CAMERA/SCR7FLFDIAG/SPECTRUM.X.TD',
+            'FLASH.DIAG/CAMERA/SCR7FLFDIAG/SPECTRUM.Y.TD']
+
+
+def make_bundles(sim: MachineSimulator, channels: list, n: int):
+    bundles = []
+    for i in range(n):
+        data = [{'data': sim.payload(addr), 'macropulse': 1000000 + i, 'timestamp': time.time(),
+                 'type': 'SPECTRUM' if 'SPECTRUM' in addr else 'FLOAT', 'miscellaneous': {'channel': addr}}
+                for addr in channels]
+        bundles.append({'data': data, 'macropulse': 1000000 + i, 'timestamp': time.time(), 'type': 'A_DICT',
+                        'miscellaneous': {'synchronous': 0}})
+    return bundles
+
+
+def run(steps: int, samples: int, channels: list, tmpdir: str):
+    bundles = make_bundles(MachineSimulator(latency=0.0, jitter=0.0), channels, steps * samples)
+    results = []
+    for name, policy in POLICIES.items():
+        filename = os.path.join(tmpdir, name + '.h5')
+        dfile = FLASHDataStruct(filename=filename, shape=(steps, samples), storage=StoragePolicy(policy))
+        t_start = time.perf_counter()
+        with dfile:
+            for i, bundle in enumerate(bundles):
+                dfile.dump(data_struct=bundle, idx=(i // samples, i % samples))
+        elapsed = time.perf_counter() - t_start
+        results.append((name, elapsed, os.path.getsize(filename)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Compare HDF5 write throughput and file size across storage policies.')
+    parser.add_argument('--steps', type=int, default=11)
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = run(steps=args.steps, samples=args.samples, channels=CHANNELS, tmpdir=tmpdir)
+    reference = results[0][2]
+    print('{:<24}{:>12}{:>14}{:>12}{:>10}'.format('policy', 'time [s]', 'samples/s', 'size [MB]', 'ratio'))
+    for name, elapsed, size in results:
+        print('{:<24}{:>12.3f}{:>14.1f}{:>12.2f}{:>10.2f}'.format(name, elapsed, args.steps * args.samples / elapsed,
+                                                                  size / 1e6, reference / size))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+from threading import Event, Lock
+import time
+
+from control_system import Error
+
+
+class WaitTimeout(Error):
+    pass
+
+
+class WaitStats(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self.waits = {}
+
+    def record(self, name: str, elapsed: float, timed_out: bool = False):
+        with self._lock:
+            entry = self.waits.setdefault(name, {'waits': 0, 'timeouts': 0, 'total': 0.0, 'max': 0.0})
+            entry['waits'] += 1
+            entry['timeouts'] += int(timed_out)
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+
+    def reset(self):
+        with self._lock:
+            self.waits = {}
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {name: dict(entry, mean=entry['total'] / entry['waits']) for name, entry in self.waits.items()}
+
+
+wait_stats = WaitStats()
+
+
+class Deadline(object):
+
+    def __init__(self, timeout: float = None, stop_event: Event = None, name: str = 'wait'):
+        self.timeout = timeout
+        self.stop_event = stop_event
+        self.name = name
+        self.start = time.monotonic()
+        self.expires = None if timeout is None else self.start + timeout
+        self._recorded = False
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(self.expires - time.monotonic(), 0.0)
+
+    @property
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    @property
+    def stopped(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def renew(self, timeout: float = None):
+        self.timeout = self.timeout if timeout is None else timeout
+        self.expires = None if self.timeout is None else time.monotonic() + self.timeout
+
+    def sleep(self, interval: float):
+        remaining = self.remaining
+        interval = max(interval if remaining is None else min(interval, remaining), 0.0)
+        if self.stop_event is not None:
+            self.stop_event.wait(interval)
+        else:
+            time.sleep(interval)
+        return not self.stopped and not self.expired
+
+    def done(self, timed_out: bool = False):
+        if not self._recorded:
+            self._recorded = True
+            wait_stats.record(self.name, self.elapsed, timed_out)
+
+    def fail(self, message: str = None):
+        self.done(timed_out=True)
+        raise WaitTimeout(message if message else '{}: TIMEOUT after {:.2f} s!!!'.format(self.name, self.elapsed))
+
+    def wait_until(self, predicate, interval: float = 0.1, message: str = None):
+        while True:
+            result = predicate()
+            if result:
+                self.done()
+                return result
+            if self.stopped:
+                self.done()
+                return None
+            if self.expired:
+                self.fail(message)
+            self.sleep(interval)